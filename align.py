@@ -0,0 +1,103 @@
+'''
+As of alignment of series with different frequencies (daily rates, month
+end CPI, irregular prints). Every input is joined onto one set of dates in
+a single pass: each input's dates are searched once (numpy searchsorted)
+for the last observation on or before every target date and its columns
+are gathered at those positions. Values older than tolerance are left
+missing so a stale monthly print is not carried for ever. Inputs are never
+changed and only the gathered columns are copied
+'''
+import numpy
+import pandas
+from database import DATE
+
+# Tolerance of exact date matches only (an outer join), None is unlimited
+EXACT = pandas.Timedelta(0)
+DATE_NS = "datetime64[ns]"
+NO_DATE = "Cannot align {}: no {} column or datetime index"
+
+
+def _dates(values):
+    '''Dates (strings, datetimes or index) as a datetime64 array'''
+    return numpy.asarray(pandas.to_datetime(values), dtype=DATE_NS)
+
+
+def _columns(data):
+    '''Dates, column names and columns of a series or of a dataframe with
+       a date column or a datetime index'''
+    if isinstance(data, pandas.Series):
+        return _dates(data.index), [data.name], [data.to_numpy()]
+    if DATE in data.columns:
+        dates = data[DATE]
+        data = data.drop(columns=DATE)
+    elif isinstance(data.index, pandas.DatetimeIndex) or \
+            data.index.name == DATE:
+        dates = data.index
+    else:
+        raise ValueError(NO_DATE.format(list(data.columns), DATE))
+    return (_dates(dates), list(data.columns),
+            [data.iloc[:, column].to_numpy()
+             for column in range(data.shape[1])])
+
+
+def _as_of(dates, target, tolerance):
+    '''Position in sorted dates of the last date on or before each target
+       date and mask of target dates with none within tolerance'''
+    positions = numpy.searchsorted(dates, target, side="right") - 1
+    missing = positions < 0
+    positions[missing] = 0
+    if tolerance is not None and len(dates):
+        missing |= target - dates[positions] > tolerance
+    return positions, missing
+
+
+def _take(values, positions, missing):
+    '''Values at positions with missing entries as NaN (NaT, None)'''
+    if not len(values):
+        return numpy.full(len(positions), numpy.nan)
+    result = values[positions]
+    if missing.any():
+        result = pandas.Series(result).mask(missing).to_numpy()
+    return result
+
+
+def align(frames, on=None, tolerance=None):
+    '''Join frames (series, or dataframes with a date column or datetime
+       index) as of every date in on, default the union of their dates.
+       Each column takes its last non missing value on or before the date,
+       left missing if that is more than tolerance (Timedelta or string
+       such as "31D") before it. EXACT tolerance is an outer join on date.
+       Returns dataframe indexed by datetime (date) with the columns of
+       every frame in order'''
+    if tolerance is not None:
+        tolerance = pandas.Timedelta(tolerance).to_timedelta64()
+    inputs = [_columns(frame) for frame in frames]
+    if on is None:
+        target = numpy.unique(numpy.concatenate(
+            [dates for dates, _, _ in inputs] or [numpy.array([], DATE_NS)]))
+    else:
+        target = numpy.unique(_dates(on))
+    names = []
+    columns = []
+    for dates, frame_names, values in inputs:
+        if (numpy.diff(dates) < numpy.timedelta64(0)).any():
+            order = numpy.argsort(dates, kind="stable")
+            dates = dates[order]
+            values = [column[order] for column in values]
+        held = None
+        for name, column in zip(frame_names, values):
+            valid = pandas.notnull(column)
+            if valid.all():
+                # One search shared by every complete column of the frame
+                if held is None:
+                    held = _as_of(dates, target, tolerance)
+                positions, missing = held
+                columns.append(_take(column, positions, missing))
+            else:
+                positions, missing = _as_of(dates[valid], target, tolerance)
+                columns.append(_take(column[valid], positions, missing))
+            names.append(name)
+    result = pandas.DataFrame(dict(enumerate(columns)),
+                              index=pandas.DatetimeIndex(target, name=DATE))
+    result.columns = names
+    return result
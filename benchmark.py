@@ -0,0 +1,379 @@
+'''Benchmarks for the price pipeline. Results are printed as JSON
+
+    python benchmark.py logged - overhead of Logged call wrapping per call
+                                 with DEBUG disabled, compared to a plain
+                                 class, for a scalar and a dataframe argument
+    python benchmark.py get_data resample ... - timed scenarios (default all)
+                                 on a synthetic database
+    python benchmark.py --symbols 200 --years 20 --output new.json
+    python benchmark.py --baseline old.json - compare with an earlier run
+
+Scenarios run against a synthetic database built from provider.csv (same
+hosts and comparison groups, symbols repeated to reach --symbols) with
+--years of prices at --frequency (monthly sources stay monthly). Updates use
+SyntheticHost in place of the provider clients so no network is needed. Each
+repeat starts from a new copy of the database as generated and a new
+Database so in-memory caches start empty. Scenarios named _materialized use
+a copy on which an update has materialized returns, the others resample from
+prices. Exit status is 1 if a scenario is slower than the baseline by more
+than --tolerance'''
+import os
+import sys
+import json
+import zlib
+import shutil
+import timeit
+import logging
+import argparse
+import tempfile
+import statistics
+import numpy
+import pandas
+from pandas.tseries.offsets import BDay
+from rnl_util import Logged, CALL_LOG
+from database import Database, dispose_engines, PROVIDER_CSV, \
+    QUANDL_DATA_PROVIDER, YAHOO_DATA_PROVIDER, DATE, SYMBOL, PRICE, \
+    COMPARISON, COPY_COLUMN, SHORT_DATE
+from returns import Returns, INDICES, GOLD, TEN_YEAR_US, CPI_US
+from setup_db import execute, CREATE_PRICE
+
+CALLS = 100000
+REPEAT = 5
+FRAME_ROWS = 100000
+NANOSECONDS = 1e9
+
+# Synthetic database
+SQLITE_URL = "sqlite:///{}"
+SYNTHETIC_DB = "synthetic.db"
+WAL_FILE = "-wal"
+SHM_FILE = "-shm"
+TEMPLATE_DB = "template.db"
+MATERIALIZED_DB = "materialized.db"
+CHART_LOCATION = "charts"
+END_DATE = "2017-09-29"
+YEARS = 10
+BUSINESS_DAY = "B"
+MONTH_START = "MS"
+# Sources marked monthly in provider.csv keep a monthly frequency
+MONTHLY = "Monthly"
+SOURCE = "source"
+# Database is this many business days behind the host for update scenarios
+UPDATE_DAYS = 20
+SYNTHETIC_SYMBOL = "{}.{}"
+# Host columns before _copy_columns maps them to price
+HOST_DATE = "Date"
+HOST_COLUMN = {QUANDL_DATA_PROVIDER: "Value", YAHOO_DATA_PROVIDER: "Close"}
+# Random walk shape by comparison group (start level, drift, volatility)
+WALK = {"Inflation": (100.0, 0.002, 0.002),
+        "10Year": (3.0, 0.0, 0.02),
+        "CentralBank": (1.0, 0.0, 0.02),
+        "Currency": (1.0, 0.0, 0.005)}
+DEFAULT_WALK = (100.0, 0.0002, 0.01)
+SCENARIO_START = "2015"
+RESULT_DIGITS = 4
+REGRESSION_TOLERANCE = 0.1
+# Result keys
+BEST = "best_s"
+FIRST = "first_s"
+MEDIAN = "median_s"
+BASELINE = "baseline_s"
+RATIO = "ratio"
+REGRESSION = "regression"
+CONFIG = "config"
+COMPARE = "comparison"
+
+
+class Plain(object):
+    '''Class without logging to measure the cost of a method call'''
+    def method(self, value):
+        '''Return value'''
+        return value
+
+
+class Wrapped(metaclass=Logged):
+    '''Same class with call logging from the metaclass'''
+    def method(self, value):
+        '''Return value'''
+        return value
+
+
+def _per_call(method, argument, calls=CALLS, repeat=REPEAT):
+    '''Best time per call in nanoseconds'''
+    best = min(timeit.repeat(lambda: method(argument), number=calls,
+                             repeat=repeat))
+    return best / calls * NANOSECONDS
+
+
+def logged_overhead(calls=CALLS, repeat=REPEAT):
+    '''Nanoseconds per call added by Logged with DEBUG disabled. Before lazy
+       rendering the dataframe case formatted the whole frame on every call'''
+    CALL_LOG.setLevel(logging.INFO)
+    frame = pandas.DataFrame({"price": range(FRAME_ROWS)})
+    result = {}
+    for name, argument in (("scalar", 1), ("dataframe", frame)):
+        plain = _per_call(Plain().method, argument, calls, repeat)
+        wrapped = _per_call(Wrapped().method, argument, calls, repeat)
+        result[name] = {"plain_ns": round(plain, 1),
+                        "logged_ns": round(wrapped, 1),
+                        "overhead_ns": round(wrapped - plain, 1)}
+    return result
+
+
+def synthetic_provider(symbols=None, filename=PROVIDER_CSV):
+    '''Provider table from provider.csv. If symbols is larger the rows are
+       repeated with numbered symbols (^FTAS.1...) in the same host and
+       comparison group, if smaller only the first symbols are kept'''
+    provider = pandas.read_csv(filename)
+    if symbols is None:
+        return provider
+    rows = [provider.iloc[i % len(provider)].copy() for i in range(symbols)]
+    for i, row in enumerate(rows):
+        if i >= len(provider):
+            row[SYMBOL] = SYNTHETIC_SYMBOL.format(row[SYMBOL],
+                                                  i // len(provider))
+    return pandas.DataFrame(rows).reset_index(drop=True)
+
+
+def synthetic_prices(symbol, comparison, dates):
+    '''Deterministic random walk for symbol (seeded by the symbol) over
+       dates, shaped by the comparison group'''
+    start, drift, volatility = WALK.get(comparison, DEFAULT_WALK)
+    random = numpy.random.default_rng(zlib.crc32(symbol.encode()))
+    steps = random.normal(drift, volatility, len(dates))
+    return pandas.Series(start * numpy.exp(numpy.cumsum(steps)), index=dates)
+
+
+class SyntheticHost(object):
+    '''Host returning synthetic prices in each provider's format so updates
+       run without network access. Prices for a symbol are the same however
+       they are requested (full history or from a start date)'''
+    def __init__(self, provider, years=YEARS, frequency=BUSINESS_DAY,
+                 end_date=END_DATE):
+        '''Initialise with provider table to know each symbol's group'''
+        self._provider = provider.set_index(SYMBOL)
+        self._end = pandas.Timestamp(end_date)
+        self._start = self._end - pandas.DateOffset(years=years)
+        self._frequency = frequency
+
+    def prices(self, symbol, start_date=None, end_date=None):
+        '''Synthetic price series of symbol between dates'''
+        row = self._provider.loc[symbol]
+        frequency = (MONTH_START if MONTHLY in str(row[SOURCE])
+                     else self._frequency)
+        dates = pandas.date_range(self._start, self._end, freq=frequency,
+                                  name=HOST_DATE)
+        result = synthetic_prices(symbol, row[COMPARISON], dates)
+        if start_date is not None:
+            result = result[result.index >= pandas.Timestamp(start_date)]
+        if end_date is not None:
+            result = result[result.index <= pandas.Timestamp(end_date)]
+        return result
+
+    def _host_data(self, host, symbol, start_date):
+        '''Prices as a dataframe with the host's column name'''
+        return self.prices(symbol, start_date).to_frame(HOST_COLUMN[host])
+
+    def get_quandl(self, symbol, start_date=None):
+        '''Synthetic Quandl data (Date index, Value)'''
+        return self._host_data(QUANDL_DATA_PROVIDER, symbol, start_date)
+
+    def get_yahoo(self, symbol, start_date=None):
+        '''Synthetic Yahoo data (Date index, Close)'''
+        return self._host_data(YAHOO_DATA_PROVIDER, symbol, start_date)
+
+    def get_csv(self, filename):
+        '''Provider table'''
+        return self._provider.reset_index()
+
+
+def _remove(filename):
+    '''Close shared engines and remove SQLite database with its WAL files'''
+    dispose_engines()
+    for path in (filename, filename + WAL_FILE, filename + SHM_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _copy(template, filename):
+    '''Replace database with a copy of template. Closing the engines
+       checkpoints the template WAL into the file before it is copied'''
+    _remove(filename)
+    shutil.copyfile(template, filename)
+
+
+def synthetic_database(filename, host, end_date=END_DATE, lag=UPDATE_DAYS):
+    '''Create SQLite database with the setup_db price table, host's
+       provider table and its prices up to lag business days before end
+       date. Returns number of prices'''
+    _remove(filename)
+    execute(CREATE_PRICE, filename)
+    data = Database(SQLITE_URL.format(filename), host=host)
+    provider = data.replace_provider()
+    end_date = pandas.Timestamp(end_date) - BDay(lag)
+
+    def frames():
+        '''Price table rows of each symbol'''
+        for symbol in provider[SYMBOL]:
+            prices = host.prices(symbol, end_date=end_date)
+            yield pandas.DataFrame({
+                SYMBOL: symbol,
+                DATE: prices.index.strftime(SHORT_DATE),
+                PRICE: prices.values}, columns=COPY_COLUMN)
+
+    return data.bulk_load(frames())
+
+
+def _comparators(data):
+    '''Chart every comparison group and wait for the charts'''
+    from charts import ChartRenderer
+    return ChartRenderer.wait(data.comparators())
+
+
+def _return_value(data):
+    '''Return values of the longest daily series'''
+    return data.return_value(data.get_data([GOLD]))
+
+
+# Scenario name to function of a new Database
+SCENARIOS = {
+    "get_data": lambda data: data.get_data(INDICES, SCENARIO_START),
+    "get_data_wide": lambda data: data.get_data(INDICES, SCENARIO_START,
+                                                wide=True),
+    "resample": lambda data: data.resample(INDICES, SCENARIO_START),
+    "return_value": _return_value,
+    "real_return": lambda data: data.real_return(TEN_YEAR_US, CPI_US,
+                                                 SCENARIO_START),
+    "compare_real_returns": lambda data: Returns(data).compare_real_returns(
+        SCENARIO_START),
+    "comparators": _comparators,
+    "update_all_symbols": lambda data: data.update_all_symbols(),
+}
+# Scenarios also timed with returns materialized by an update
+MATERIALIZED = "{}_materialized"
+SCENARIOS.update({MATERIALIZED.format(name): SCENARIOS[name] for name in
+                  ["resample", "real_return", "compare_real_returns"]})
+
+
+def run_scenario(name, filename, host, repeat=REPEAT, template=None):
+    '''Time scenario repeat times, each with a new Database on a new copy
+       of template (if given). Returns first, best and median seconds'''
+    times = []
+    for _ in range(repeat):
+        if template is not None:
+            _copy(template, filename)
+        data = Database(SQLITE_URL.format(filename), host=host)
+        start = timeit.default_timer()
+        SCENARIOS[name](data)
+        times.append(timeit.default_timer() - start)
+    return {FIRST: round(times[0], RESULT_DIGITS),
+            BEST: round(min(times), RESULT_DIGITS),
+            MEDIAN: round(statistics.median(times), RESULT_DIGITS)}
+
+
+def run_scenarios(names, symbols=None, years=YEARS, frequency=BUSINESS_DAY,
+                  repeat=REPEAT, location=None):
+    '''Build synthetic database in location (default a temporary directory)
+       and time each named scenario, every scenario on a copy of the
+       database as built (or with materialized returns). Returns dictionary
+       of results'''
+    import charts
+    location = tempfile.mkdtemp() if location is None else location
+    os.makedirs(location, exist_ok=True)
+    host = SyntheticHost(synthetic_provider(symbols), years, frequency)
+    filename = os.path.join(location, SYNTHETIC_DB)
+    template = os.path.join(location, TEMPLATE_DB)
+    rows = synthetic_database(template, host)
+    materialized = os.path.join(location, MATERIALIZED_DB)
+    if any(name.endswith(MATERIALIZED.format("")) for name in names):
+        _copy(template, materialized)
+        Database(SQLITE_URL.format(materialized), host=host)._refresh_derived()
+    chart_location = os.path.join(location, CHART_LOCATION)
+    os.makedirs(chart_location, exist_ok=True)
+    charts.configure(chart_location + os.sep)
+    result = {CONFIG: {"symbols": len(host.get_csv(PROVIDER_CSV)),
+                       "years": years, "frequency": frequency,
+                       "rows": rows, "repeat": repeat}}
+    try:
+        for name in names:
+            copied = materialized if name.endswith(MATERIALIZED.format("")) \
+                else template
+            result[name] = run_scenario(name, filename, host, repeat, copied)
+    finally:
+        charts.renderer().shutdown()
+    return result
+
+
+def compare(result, baseline, tolerance=REGRESSION_TOLERANCE):
+    '''Ratio of best time to the baseline best time for scenarios in both.
+       Regression if slower by more than tolerance (0.1 is 10%)'''
+    comparison = {}
+    for name, value in result.items():
+        if not isinstance(value, dict) or BEST not in value or \
+                BEST not in baseline.get(name, {}):
+            continue
+        ratio = value[BEST] / baseline[name][BEST] if baseline[name][BEST] \
+            else float("inf")
+        comparison[name] = {BASELINE: baseline[name][BEST],
+                            BEST: value[BEST],
+                            RATIO: round(ratio, RESULT_DIGITS),
+                            REGRESSION: ratio > 1 + tolerance}
+    return comparison
+
+
+BENCHMARKS = {"logged": logged_overhead}
+
+
+def parser():
+    '''Command line arguments'''
+    main_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    main_parser.add_argument("names", nargs="*",
+                             help="benchmarks to run (default all) from: " +
+                             ", ".join(list(BENCHMARKS) + list(SCENARIOS)))
+    main_parser.add_argument("--symbols", type=int,
+                             help="symbols (default provider.csv)")
+    main_parser.add_argument("--years", type=int, default=YEARS)
+    main_parser.add_argument("--frequency", default=BUSINESS_DAY,
+                             help="pandas frequency of daily symbols")
+    main_parser.add_argument("--repeat", type=int, default=REPEAT)
+    main_parser.add_argument("--location",
+                             help="directory for the synthetic database")
+    main_parser.add_argument("--output", help="also write JSON to file")
+    main_parser.add_argument("--baseline", help="JSON of an earlier run")
+    main_parser.add_argument("--tolerance", type=float,
+                             default=REGRESSION_TOLERANCE)
+    return main_parser
+
+
+def main(argv=None):
+    '''Run named benchmarks (default all) and print results as JSON.
+       Returns 1 if slower than baseline'''
+    main_parser = parser()
+    args = main_parser.parse_args(argv)
+    names = args.names or list(BENCHMARKS) + list(SCENARIOS)
+    unknown = set(names) - set(BENCHMARKS) - set(SCENARIOS)
+    if unknown:
+        main_parser.error("unknown benchmarks: " + ", ".join(sorted(unknown)))
+    result = {name: BENCHMARKS[name]() for name in names
+              if name in BENCHMARKS}
+    scenarios = [name for name in names if name in SCENARIOS]
+    if scenarios:
+        result.update(run_scenarios(scenarios, args.symbols, args.years,
+                                    args.frequency, args.repeat,
+                                    args.location))
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            result[COMPARE] = compare(result, json.load(baseline),
+                                      args.tolerance)
+        status = int(any(value[REGRESSION]
+                         for value in result[COMPARE].values()))
+    output = json.dumps(result, indent=1)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,166 @@
+'''
+Chart rendering in background worker processes. Charts are rendered with
+the headless Agg backend and every figure is closed after saving. Output
+filenames include a hash of the title and chart data so a chart whose data
+has not changed is not drawn again and earlier versions of a chart are
+removed once its new version is saved. matplotlib is only imported by
+workers. Workers are spawned rather than forked as charts are submitted
+from threads (derived graph, service) of a process holding database
+connections
+'''
+import os
+import glob
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+import pandas
+from database import DATE, SAVE_LOCATION
+from rnl_util import Logged
+
+AGG = "Agg"
+FIGURE_SIZE = (16, 10)
+CHART_WORKERS = 2
+HASH_LENGTH = 12
+CHART_FILE = "{}_{}.png"
+SAVED = "Saved chart to {}"
+UNCHANGED = "Chart unchanged {}"
+# Any version of a chart, the hash is HASH_LENGTH hex characters
+ANY_HASH = "?" * HASH_LENGTH
+SPAWN = "spawn"
+
+
+def render(title, chart_data, filename):
+    '''Render chart to PNG file. Runs in a worker process'''
+    import matplotlib
+    matplotlib.use(AGG)
+    import matplotlib.pyplot as pyplot
+    figure = chart_data.plot(x=DATE, title=title,
+                             figsize=FIGURE_SIZE).get_figure()
+    try:
+        figure.savefig(filename)
+    finally:
+        pyplot.close(figure)
+    return SAVED.format(filename)
+
+
+def content_hash(title, chart_data):
+    '''Short hash of title, column names and values (with index)'''
+    digest = hashlib.sha1(title.encode())
+    digest.update(repr(list(chart_data.columns)).encode())
+    digest.update(pandas.util.hash_pandas_object(chart_data).values.tobytes())
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+class ChartRenderer(metaclass=Logged):
+    '''Render charts on a process pool, returning futures of the message
+       saying where the chart was saved. Safe to share between threads.
+       Public methods:
+           submit - render one chart unless unchanged chart exists
+           submit_all - render a batch of (title, data) charts
+           wait - block until futures are complete and return messages'''
+    def __init__(self, location=SAVE_LOCATION, workers=CHART_WORKERS):
+        '''Initialise renderer, pool is started on first chart'''
+        self._location = location
+        self._workers = workers
+        self._pool = None
+        self._pending = {}
+        # Guards the pool and pending charts
+        self._lock = threading.Lock()
+        self._log = Logged.logger(__name__)
+
+    def _executor(self):
+        '''Process pool started on first use, called holding the lock'''
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self._workers,
+                mp_context=multiprocessing.get_context(SPAWN))
+        return self._pool
+
+    def _done(self, title, filename, future):
+        '''Log result of rendering, forget pending chart and remove earlier
+           versions of the chart once it is saved'''
+        with self._lock:
+            self._pending.pop(filename, None)
+        if future.exception() is None:
+            self._log.info(future.result())
+            self._remove_superseded(title, filename)
+        else:
+            self._log.info("Chart %s failed: %r", filename,
+                           future.exception())
+
+    def submit(self, title, chart_data):
+        '''Render chart in the background. Returns completed future if the
+           same chart already exists or the pending future if it is being
+           rendered'''
+        filename = self._location + CHART_FILE.format(
+            title, content_hash(title, chart_data))
+        with self._lock:
+            if filename in self._pending:
+                return self._pending[filename]
+            if os.path.exists(filename):
+                future = Future()
+                future.set_result(UNCHANGED.format(filename))
+                return future
+            future = self._executor().submit(render, title, chart_data,
+                                             filename)
+            self._pending[filename] = future
+        # Outside the lock as a completed future calls back at once
+        future.add_done_callback(
+            lambda done: self._done(title, filename, done))
+        return future
+
+    def _remove_superseded(self, title, filename):
+        '''Delete other versions of the chart with title, except any still
+           being rendered'''
+        pattern = self._location + CHART_FILE.format(
+            glob.escape(title), ANY_HASH)
+        with self._lock:
+            pending = set(self._pending)
+        for superseded in glob.glob(pattern):
+            if superseded != filename and superseded not in pending:
+                try:
+                    os.remove(superseded)
+                except FileNotFoundError:
+                    pass
+                self._log.info("Removed superseded chart %s", superseded)
+
+    def submit_all(self, charts):
+        '''Render several (title, data) charts, returns list of futures'''
+        return [self.submit(title, chart_data) for title, chart_data in charts]
+
+    @staticmethod
+    def wait(futures):
+        '''Wait for futures and return their messages'''
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        '''Wait for pending charts and stop worker processes'''
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+
+_RENDERER = None
+_RENDERER_LOCK = threading.Lock()
+
+
+def renderer():
+    '''Shared renderer so all charts in a process use one pool'''
+    global _RENDERER
+    with _RENDERER_LOCK:
+        if _RENDERER is None:
+            _RENDERER = ChartRenderer()
+        return _RENDERER
+
+
+def configure(location=SAVE_LOCATION, workers=CHART_WORKERS):
+    '''Replace shared renderer, e.g. to save charts somewhere else'''
+    global _RENDERER
+    configured = ChartRenderer(location, workers)
+    with _RENDERER_LOCK:
+        previous, _RENDERER = _RENDERER, configured
+    if previous is not None:
+        previous.shutdown()
+    return configured
@@ -0,0 +1,171 @@
+'''
+Cross currency conversion of dollar priced assets (gold) into local
+currencies and of each currency against the dollar index. Asset, exchange
+rate and index prices are aligned once on a date x symbol panel with prices
+carried forward over holidays. Every asset x currency conversion is then a
+single broadcast multiply of the asset prices by units of each currency per
+dollar. After new prices are written only the rows after the last held date
+are read and converted, unless a price on or before it was revised
+'''
+import numpy
+import pandas
+from database import DATE, START, SHORT_DATE
+from rnl_util import Logged
+
+GOLD = "WGC/GOLD_DAILY_USD"
+SPDR_GLD_ETF = "GLD"
+DOLLAR_INDEX = "CHRIS/ICE_DX1"
+USD = "USD"
+# Bank of England quotes sterling and euro as dollars per unit (inverted,
+# power -1) and yuan and yen as units per dollar (power 1)
+CURRENCIES = {"GBP": ("BOE/XUDLGBD", -1),
+              "EUR": ("BOE/XUDLERD", -1),
+              "CNY": ("BOE/XUDLBK73", 1),
+              "JPY": ("BOE/XUDLJYD", 1)}
+ASSETS = [GOLD, SPDR_GLD_ETF]
+ASSET = "asset"
+CURRENCY = "currency"
+
+
+class CurrencyMatrix(metaclass=Logged):
+    '''Dollar priced assets converted to every currency. Public methods:
+           refresh - read prices written since the last refresh
+           matrix - date x (asset, currency) prices, optionally resampled
+           gold - gold price in each currency
+           currency_index - each currency against the dollar index'''
+    def __init__(self, database, assets=ASSETS, currencies=CURRENCIES,
+                 dollar_index=DOLLAR_INDEX):
+        '''Initialise with a Database, assets priced in dollars and
+           dictionary of currency to (exchange rate symbol, power) where
+           rate ** power is units of currency per dollar'''
+        self._data = database
+        self._assets = list(assets)
+        self._currencies = [USD] + list(currencies)
+        self._rates = [currencies[currency][START]
+                       for currency in currencies]
+        self._powers = numpy.array([currencies[currency][1]
+                                    for currency in currencies], dtype=float)
+        self._index = dollar_index
+        self._symbols = list(dict.fromkeys(self._assets + self._rates +
+                                           [dollar_index]))
+        self._aligned = None
+        self._held = None
+        self._per_dollar = None
+        self._matrix = None
+        self._log = Logged.logger(__name__)
+
+    def _watermark(self):
+        '''Last date, count and write version of each symbol, None if it
+           has no prices'''
+        return self._data.watermarks(self._symbols)
+
+    def _panel(self, start_date=None):
+        '''Wide date x symbol prices after start date with datetime index'''
+        return self._data.get_data(self._symbols, start_date, wide=True,
+                                   compact=True)
+
+    def _tail(self, held, watermark):
+        '''Earliest last date held and prices after it, or None if rows
+           were added, removed or revised before it (history changed)'''
+        dates = [held[symbol][START] for symbol in self._symbols
+                 if held[symbol] is not None]
+        start = min(dates) if dates else None
+        tail = self._panel(start)
+        for symbol in self._symbols:
+            if watermark[symbol] is None:
+                if held[symbol] is not None:
+                    return None
+                continue
+            added = tail[symbol].notnull()
+            count = 0
+            if held[symbol] is not None:
+                last_date, count, version = held[symbol]
+                added &= tail.index > pandas.Timestamp(last_date)
+                if version != watermark[symbol][2]:
+                    written = self._data._written_since(symbol, version)
+                    if written is None or written <= last_date:
+                        return None
+            if count + int(added.sum()) != watermark[symbol][1]:
+                return None
+        return start, tail
+
+    def _convert(self, aligned):
+        '''Units of each currency per dollar and assets in every currency
+           for aligned (carried forward) prices'''
+        rates = aligned[self._rates].values
+        per_dollar = numpy.column_stack([numpy.ones(len(aligned)),
+                                         rates ** self._powers])
+        assets = aligned[self._assets].values
+        # dates x assets x 1 times dates x 1 x currencies
+        converted = assets[:, :, None] * per_dollar[:, None, :]
+        columns = pandas.MultiIndex.from_product(
+            [self._assets, self._currencies], names=[ASSET, CURRENCY])
+        per_dollar = pandas.DataFrame(per_dollar, index=aligned.index,
+                                      columns=pandas.Index(self._currencies,
+                                                           name=CURRENCY))
+        matrix = pandas.DataFrame(converted.reshape(len(aligned), -1),
+                                  index=aligned.index, columns=columns)
+        return per_dollar, matrix
+
+    def refresh(self):
+        '''Bring conversions up to date with the database. Only prices after
+           the last held date are read and converted unless history changed.
+           Returns number of dates converted'''
+        watermark = self._watermark()
+        if watermark == self._held:
+            return 0
+        extend = None
+        if self._held is not None:
+            extend = self._tail(self._held, watermark)
+        if extend is None:
+            self._aligned = self._panel().ffill()
+            self._per_dollar, self._matrix = self._convert(self._aligned)
+            converted = len(self._aligned)
+        else:
+            start, tail = extend
+            keep = self._aligned.index <= pandas.Timestamp(start)
+            # Carry forward from the last kept row into the tail
+            aligned = pandas.concat([self._aligned[keep].iloc[-1:], tail])
+            aligned = aligned.ffill().iloc[int(keep.any()):]
+            per_dollar, matrix = self._convert(aligned)
+            self._aligned = pandas.concat([self._aligned[keep], aligned])
+            self._per_dollar = pandas.concat([self._per_dollar[keep],
+                                              per_dollar])
+            self._matrix = pandas.concat([self._matrix[keep], matrix])
+            converted = len(tail)
+        self._held = watermark
+        self._log.info("Currency matrix converted %i dates", converted)
+        return converted
+
+    def matrix(self, period=None, start_date=None):
+        '''Date x (asset, currency) prices after refresh, optionally from
+           start date and resampled to period'''
+        self.refresh()
+        return self._select(self._matrix, period, start_date)
+
+    def gold(self, period=None, start_date=None):
+        '''Gold price in each currency, date x currency'''
+        return self.matrix(period, start_date)[GOLD]
+
+    def currency_index(self, period=None, start_date=None):
+        '''Each currency against the basket of the dollar index, i.e. the
+           index divided by units of currency per dollar (USD is the index)'''
+        self.refresh()
+        index = self._aligned[self._index].values
+        result = pandas.DataFrame(index[:, None] / self._per_dollar.values,
+                                  index=self._per_dollar.index,
+                                  columns=self._per_dollar.columns)
+        return self._select(result, period, start_date)
+
+    @staticmethod
+    @Logged.unlogged
+    def _select(data, period=None, start_date=None):
+        '''Copy of dates after start date (as get_data, 2016 or 2016-05)
+           resampled to the last price of each period (M, Q, A)'''
+        if start_date is not None:
+            data = data[data.index.strftime(SHORT_DATE) > str(start_date)]
+        if period is not None:
+            data = data.resample(period).last()
+        data = data.copy()
+        data.index.name = DATE
+        return data
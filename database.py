@@ -3,33 +3,135 @@ Database handler using SQLAlchemy and SQLite3 for simplicity. Database holds
 price information from primarily yahoo and quandl. Pandas is used to get data
 Various information sources format the data differently - format is shown in
 Provider table ("source"). All data gathered is written based on date,
-symbol and price (close) as no analysis requires bars (OHLC) or volume
+symbol and price (close) as no analysis requires bars (OHLC) or volume.
+Provider clients (quandl, pandas_datareader) are imported when first used
+so reading the database does not pay for them
 '''
+import time
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy
 import pandas
-from pandas.tseries.offsets import BDay
-import pandas_datareader.data as web
-
-
-import quandl
-from sqlalchemy import create_engine
-from rnl_util import Logged
+from sqlalchemy import create_engine, text, bindparam, event, inspect
+from sqlalchemy.engine import make_url
+from rnl_util import Logged, LRUCache, CACHE_SIZE, METRICS
 
 # Database
 SQLALCHEMY = "SQLAlchemy {}"
 SQLALCHEMY_DB = "sqlite:///prices.db"
-SELECT_PRICE = "select * from price"
 SELECT_QUANDL = "select symbol from provider where host='quandl'"
 SELECT_YAHOO = "select symbol from provider where host='yahoo'"
 SELECT_SYMBOL = "select symbol from provider"
-SELECT_COMPARATORS = "select distinct comparison from provider"
-SELECT_COMPARISON = "select symbol from provider where comparison='{}'"
-SELECT_DATE = "select date from price where symbol='{}'"
-SELECT_PRICE_WHERE = "select * from price where symbol='{}'"
+SELECT_SYMBOL_HOST = "select symbol, host from provider"
+# Prices of every comparison group in one scan, symbols in provider order
+SELECT_COMPARATOR_PRICES = ("select provider.comparison, price.symbol, "
+                            "price.date, price.price from provider "
+                            "join price on price.symbol = provider.symbol "
+                            "where provider.comparison is not null "
+                            "order by provider.rowid, price.date")
+# Bond and inflation of each country (provider.csv country column) in
+# provider order. Databases without the column need replace_provider
+SELECT_REAL_RETURN_PAIRS = ("select bond.country, bond.symbol as bond, "
+                            "cpi.symbol as cpi from provider bond "
+                            "join provider cpi on cpi.country = bond.country "
+                            "where bond.comparison = '10Year' "
+                            "and cpi.comparison = 'Inflation' "
+                            "order by bond.rowid")
+# Watermark (last date and count) uses (symbol, date) key from setup_db
+SELECT_WATERMARK = ("select symbol, max(date) as last_date, "
+                    "count(*) as count from price group by symbol")
+SELECT_WATERMARK_WHERE = ("select symbol, max(date) as last_date, "
+                          "count(*) as count from price where symbol='{}' "
+                          "group by symbol")
+# Watermark of some symbols, index seeks on the key rather than a scan
+SELECT_WATERMARK_SYMBOLS = ("select symbol, max(date) as last_date, "
+                            "count(*) as count from price "
+                            "where symbol in :symbols group by symbol")
+# Write log - every price write adds a row per symbol with the next
+# version and the earliest date written. Derived data (snapshot, returns)
+# records the version it was built from, as a price revised in place
+# changes neither last date nor count
+CREATE_WRITE = '''CREATE TABLE IF NOT EXISTS price_write
+                   (symbol text NOT NULL, version integer NOT NULL,
+                   first_date text NOT NULL, PRIMARY KEY (symbol, version))
+                   WITHOUT ROWID'''
+INSERT_WRITE = ("insert into price_write (symbol, version, first_date) "
+                "select :symbol, coalesce(max(version), 0) + 1, "
+                ":first_date from price_write where symbol = :symbol")
+SELECT_VERSION = ("select symbol, max(version) as version from price_write "
+                  "group by symbol")
+SELECT_VERSION_SYMBOLS = ("select symbol, max(version) as version "
+                          "from price_write where symbol in :symbols "
+                          "group by symbol")
+SELECT_WRITTEN_SINCE = ("select min(first_date) as first_date "
+                        "from price_write where symbol = :symbol "
+                        "and version > :version")
+# First price after a start date, as get_data filters dates
+SELECT_FIRST_DATE = ("select symbol, min(date) as first_date from price "
+                     "where symbol in :symbols and date > :start_date "
+                     "group by symbol")
+FIRST_DATE = "first_date"
+# Price for any set of symbols in one query with dates filtered in SQL
+SELECT_PRICE_SYMBOLS = ("select symbol, date, price from price "
+                        "where symbol in :symbols")
+WHERE_START_DATE = " and date > :start_date"
+WHERE_END_DATE = " and date <= :end_date"
+ORDER_SYMBOL_DATE = " order by symbol, date"
+SYMBOLS = "symbols"
+START_DATE = "start_date"
+END_DATE = "end_date"
+PERIOD = "period"
+LIMIT = "limit"
+# Metrics (rnl_util.METRICS) names
+ROWS_READ = "rows_read"
+ROWS_WRITTEN = "rows_written.{}"
+BYTES_FETCHED = "bytes_fetched.{}"
+SQL_READ = "sql.read"
+SQL_WRITE = "sql.write"
+# Deletes every materialized return as all dates compare greater
+ALL_DATES = ""
 SELECT_PROVIDER = "select distinct host from provider"
 DEFAULT_TO_APPEND = "append"
 UPDATE_MODE_REPLACE = "replace"
 DB_PRICE_TABLE = "price"
 DB_PROVIDER_TABLE = "provider"
+DB_WRITE_TABLE = "price_write"
+DB_RETURN_TABLE = "price_return"
+DB_RETURN_WATERMARK_TABLE = "price_return_watermark"
+# Materialized returns of resampled prices by symbol and period. Rows are
+# kept without percent change as context for extending. Watermark is the
+# price table watermark (with write version) the returns were last built
+# from
+CREATE_RETURN = '''CREATE TABLE IF NOT EXISTS price_return
+                    (symbol text NOT NULL, period text NOT NULL,
+                    date text NOT NULL, price real, percent_change real,
+                    total_return real, PRIMARY KEY (symbol, period, date))
+                    WITHOUT ROWID'''
+CREATE_RETURN_WATERMARK = '''CREATE TABLE IF NOT EXISTS price_return_watermark
+                              (symbol text NOT NULL, period text NOT NULL,
+                              last_date text, count integer, version integer,
+                              PRIMARY KEY (symbol, period)) WITHOUT ROWID'''
+DROP_TABLE = "DROP TABLE IF EXISTS {}"
+SELECT_RETURN_WATERMARK = ("select symbol, last_date, count, version "
+                           "from price_return_watermark "
+                           "where period = :period and symbol in :symbols")
+# Stored periods before the period holding the earliest date written
+SELECT_RETURN_TAIL = ("select date, price from price_return "
+                      "where symbol = :symbol and period = :period "
+                      "and date < :date order by date desc limit :limit")
+SELECT_RETURN_BASE = ("select date, price from price_return "
+                      "where symbol = :symbol and period = :period "
+                      "and percent_change is not null order by date limit 1")
+SELECT_RETURN = ("select date, symbol, price, percent_change, total_return "
+                 "from price_return where period = :period "
+                 "and symbol in :symbols")
+WHERE_RETURN_CHANGE = " and percent_change is not null"
+DELETE_RETURN = ("delete from price_return where symbol = :symbol "
+                 "and period = :period and date > :date")
+UPSERT_RETURN_WATERMARK = ("insert or replace into price_return_watermark "
+                           "values (:symbol, :period, :last_date, :count, "
+                           ":version)")
 
 # Price providers
 PROVIDER_CSV = "provider.csv"
@@ -44,27 +146,108 @@ COLUMN_MAP = {"Date": "date",
               "Settle": "price",
               "Close": "price"}
 COPY_COLUMN = ["date", "symbol", "price"]
+PRICE_KEY = ["symbol", "date"]
 DATE = "date"
 SYMBOL = "symbol"
 HOST = "host"
 COMPARISON = "comparison"
+COUNTRY = "country"
+BOND = "bond"
+CPI = "cpi"
 PRICE = "price"
+LAST_DATE = "last_date"
+COUNT = "count"
+VERSION = "version"
+NO_VERSION = 0
 COLUMN_LOCATION = 0
 COLUMN = 1
 TODAY = "today"
 NEXT_BUSINESS_DAY = 1
 SLICE_DATE = 10
 START = 0
-TUPLE_VALUES = 1
 OFFSET_ZERO_START = 1
 MONTH = "M"
+QUARTER = "Q"
 YEAR = "A"
 ANNUAL = 12
+PERIODS = [MONTH, QUARTER, YEAR]
+# Periods in a year so percent change is always compared to a year ago
+RETURN_PERIODS = {MONTH: ANNUAL, QUARTER: 4, YEAR: 1}
+# Periods whose returns are materialized after each update, others (and
+# symbols not yet materialized) are resampled from prices by resample_panel
+MATERIALIZED_PERIODS = [MONTH]
+SHORT_DATE = "%Y-%m-%d"
+FIRST = "first"
+DATE_DAY = "datetime64[D]"
+DAY = "D"
 PCT = 100
 PCT_CHANGE = "percent_change"
 TOTAL_RETURN = "total_return"
+RESAMPLE_COLUMN = [DATE, SYMBOL, PRICE, PCT_CHANGE, TOTAL_RETURN]
+# Cache keys start with the name of the cached method
+GET_DATA = "get_data"
+RESAMPLE = "resample"
+RESAMPLE_PANEL = "resample_panel"
+MOMENTUM = "momentum"
+# Momentum - direction compared to 3, 6, 9, 12 and 24 months ago
+HORIZONS = [3, 6, 9, 12, 24]
+HORIZON_LABEL = "{}{}"
 REAL_RETURN = "real_return"
-RESET_INDEX_NAME = "index"
+OUTER = "outer"
+# Real return uses the last annual inflation up to a month before each date
+REAL_RETURN_TOLERANCE = "31D"
+# Compact price frames - symbol as a category (integer codes into the list
+# of symbols), datetime64 dates and float64 or float32 prices
+FLOAT32 = "float32"
+FLOAT64 = "float64"
+
+# Concurrent update - workers per host limit parallel requests to each
+# provider, retries wait RETRY_BACKOFF seconds doubling after each failure
+HOST_WORKERS = {QUANDL_DATA_PROVIDER: 4, YAHOO_DATA_PROVIDER: 2}
+DEFAULT_WORKERS = 1
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF = 1.0
+WRITE_BATCH = 10
+STATUS = "status"
+ATTEMPTS = "attempts"
+ROWS = "rows"
+ERROR = "error"
+UPDATED = "updated"
+CURRENT = "current"
+EMPTY = "empty"
+FAILED = "failed"
+SUMMARY_COLUMN = [SYMBOL, HOST, STATUS, ATTEMPTS, ROWS, ERROR]
+
+# Bulk load - rows are written with executemany on the SQLite connection
+# and committed every BULK_CHUNK rows. Journal is WAL (see engine registry)
+# and fsync is off during the load, previous settings are restored after.
+# A crash during a bulk load can lose the last chunks so it is meant for
+# rebuilding prices.db, not for routine updates
+BULK_CHUNK = 100000
+BULK_PRAGMAS = {"synchronous": "OFF", "cache_size": -262144}
+PRAGMA_GET = "PRAGMA {}"
+PRAGMA_SET = "PRAGMA {} = {}"
+BULK_COLUMN = [SYMBOL, DATE, PRICE]
+UPSERT_PRICE = ("insert into price (symbol, date, price) values (?, ?, ?) "
+                "on conflict (symbol, date) "
+                "do update set price=excluded.price")
+SQLITE = "sqlite"
+SQL_BULK = "sql.bulk"
+
+# Engine registry - one pooled engine per database URL for writing and one
+# for reading. SQLite files use WAL so readers do not block (or wait for)
+# a writer, a larger page cache and memory mapped reads. Read engines open
+# the file read only so many analytics workers can share prices.db
+ENGINES = {}
+ENGINE_LOCK = threading.Lock()
+SQLITE_PRAGMAS = {"journal_mode": "WAL", "synchronous": "NORMAL",
+                  "cache_size": -65536, "mmap_size": 268435456,
+                  "busy_timeout": 5000}
+READ_PRAGMAS = {"cache_size": -65536, "mmap_size": 268435456,
+                "busy_timeout": 5000}
+READ_ONLY_QUERY = {"mode": "ro", "uri": "true"}
+URI_FILE = "file:{}"
+MEMORY_DATABASES = [None, "", ":memory:"]
 
 # Chart
 SAVE_LOCATION = "c:\\temp\\"
@@ -79,21 +262,81 @@ TEN_YEAR_RATE = "10Year"
 DOLLAR_INDEX = "DollarIndex"
 CURRENCY = "Currency"
 INFLATION = "Inflation"
-STRIP_OR_CLAUSE = -4
+
+
+def _sqlite_file(database):
+    '''True if SQLAlchemy URL is an SQLite database file'''
+    url = make_url(database)
+    return (url.get_backend_name() == SQLITE and
+            url.database not in MEMORY_DATABASES)
+
+
+def _pragmas(pragmas, dbapi_connection, connection_record):
+    '''Set pragmas on each new SQLite connection'''
+    cursor = dbapi_connection.cursor()
+    for pragma, value in pragmas.items():
+        cursor.execute(PRAGMA_SET.format(pragma, value))
+    cursor.close()
+
+
+def get_engine(database=SQLALCHEMY_DB, read_only=False):
+    '''Shared engine of database URL, created on first use with tuned
+       SQLite settings. Read only engines are separate for SQLite files and
+       the same as the write engine otherwise'''
+    read_only = read_only and _sqlite_file(database)
+    key = (database, read_only)
+    with ENGINE_LOCK:
+        engine = ENGINES.get(key)
+        if engine is None:
+            url = make_url(database)
+            pragmas = SQLITE_PRAGMAS if _sqlite_file(database) else None
+            if read_only:
+                url = url.set(database=URI_FILE.format(url.database),
+                              query=READ_ONLY_QUERY)
+                pragmas = READ_PRAGMAS
+            engine = create_engine(url)
+            if pragmas is not None:
+                event.listen(engine, "connect",
+                             functools.partial(_pragmas, pragmas))
+            ENGINES[key] = engine
+    return engine
+
+
+def dispose_engines():
+    '''Close pooled connections of every engine, e.g. after fork'''
+    with ENGINE_LOCK:
+        for engine in ENGINES.values():
+            engine.dispose()
+        ENGINES.clear()
 
 
 class Host(metaclass=Logged):
     '''Functions to get data using Pandas from Quandl, Yahoo or CSV files.
        Symbols are held in the provider table and are unique to each host'''
     @staticmethod
+    @Logged.histogram
     def get_quandl(symbol, start_date=None):
         '''Get web hosted data from Quandl'''
-        return quandl.get(symbol, start_date=start_date)
+        import quandl
+        return Host._fetched(QUANDL_DATA_PROVIDER,
+                             quandl.get(symbol, start_date=start_date))
 
     @staticmethod
+    @Logged.histogram
     def get_yahoo(symbol, start_date=None):
         '''Get web hosted data from Yahoo'''
-        return web.DataReader(symbol, YAHOO_DATA_PROVIDER, start_date)
+        import pandas_datareader.data as web
+        return Host._fetched(YAHOO_DATA_PROVIDER,
+                             web.DataReader(symbol, YAHOO_DATA_PROVIDER,
+                                            start_date))
+
+    @staticmethod
+    @Logged.unlogged
+    def _fetched(host, result):
+        '''Count size of host data in metrics (timing is from Logged)'''
+        METRICS.count(BYTES_FETCHED.format(host),
+                      int(result.memory_usage(deep=True).sum()))
+        return result
 
     @staticmethod
     def get_csv(filename):
@@ -108,42 +351,219 @@ class Database(metaclass=Logged):
        host data providers. Public methods:
            replace_provider - redefine table entries, primarily addition
            get_host_data - get data in defined format (date, symbol, price)
-           get_data - get all database data for symbol(s) from specified date
+           resample - resample symbols to a period with return values
+           resample_panel - resample symbols to several periods in one pass
+           get_data - get database data for symbol(s) between dates in one
+                      query, long (date, symbol, price) or wide (date x symbol)
            update_all_symbols - update database with latest host data
+           update_concurrent - update all symbols with parallel host requests
            update_symbol - update individual symbol in database
-           report - list symbols and simple count of price points
+           bulk_load - write a stream of price dataframes in large batches
+           backfill - reload full history of symbols with bulk_load
+           report - list symbols with last date and count of price points
+           watermarks - symbol to (last date, count, write version)
            comparators - chart similar (inflation, 10Year...) symbols
-           chart - write chart to PNG file'''
-    def __init__(self, database=SQLALCHEMY_DB):
-        '''Initialise database and prepare to get host data'''
-        self._engine = create_engine(database)
-        self._host = Host()
+           comparator_panels - date x symbol prices of each comparison
+           chart - write chart to PNG file in the background
+           charts - write several charts to PNG files in the background
+           cache_stats - hit and miss counts for cached queries
+           invalidate - forget cached results after writes elsewhere
+           real_return_panel - real returns of many bond and CPI pairs
+           real_return_pairs - bond and CPI of each country in provider
+           momentum - percent change over several horizons for symbols
+           direction - up (1), down (-1) or flat (0) over each horizon'''
+    def __init__(self, database=SQLALCHEMY_DB, host=None,
+                 cache_size=CACHE_SIZE, snapshot=None, read_only=False):
+        '''Initialise database and prepare to get host data. Host can be
+           replaced by any object with the same get_ methods (e.g. a fake).
+           get_data and resample_panel results are cached for cache_size
+           calls and invalidated when prices for their symbols are written.
+           Optional snapshot (snapshot.Snapshot) is used to load prices
+           instead of SQL and refreshed after each update, symbols it holds
+           behind the database are read with SQL until then. Engines are
+           shared by every Database of the same URL (see get_engine) and
+           reads use the read only engine. Read only also writes with it so
+           any write to a SQLite file fails'''
+        self._database = database
+        self._engine = get_engine(database, read_only)
+        self._host = Host() if host is None else host
+        self._cache = LRUCache(cache_size)
+        self._snapshot = snapshot
+        self._return_tables = False
+        self._write_table = False
         self._log = Logged.logger(__name__)
+        if snapshot is not None:
+            snapshot.verify(self.watermark())
 
     def __str__(self):
         '''String representation of active database connection'''
         return SQLALCHEMY.format(self._engine)
 
-    def _get(self, query):
+    def _get(self, query, params=None):
         '''Get data from the database using Pandas SQL query'''
-        return pandas.read_sql(query, self._engine)
+        start = time.perf_counter()
+        result = pandas.read_sql(query, get_engine(self._database, True),
+                                 params=params)
+        METRICS.observe(SQL_READ, time.perf_counter() - start)
+        METRICS.count(ROWS_READ, len(result))
+        return result
 
     def _set(self, table, df_data, update=DEFAULT_TO_APPEND, idx=False):
         '''Update database table with Pandas dataframe. Default append and
-           index is not included'''
-        return df_data.to_sql(table, self._engine, if_exists=update, index=idx)
+           index is not included. Appending to price is an upsert so prices
+           already held for a (symbol, date) are replaced and not duplicated.
+           Price table must have the key from setup_db (see migrate_db)'''
+        method = None
+        written = {}
+        if table == DB_PRICE_TABLE:
+            df_data = self._storable(df_data)
+            written = self._first_dates(df_data)
+            self._cache.invalidate(list(written))
+            if self._snapshot is not None:
+                self._snapshot.invalidate(written)
+            self._create_write_table()
+            if update == DEFAULT_TO_APPEND:
+                method = self._upsert
+        start = time.perf_counter()
+        # Prices and their write log in one transaction
+        with self._engine.begin() as conn:
+            result = df_data.to_sql(table, conn, if_exists=update,
+                                    index=idx, method=method)
+            if written:
+                conn.execute(text(INSERT_WRITE), self._write_log(written))
+        METRICS.observe(SQL_WRITE, time.perf_counter() - start)
+        METRICS.count(ROWS_WRITTEN.format(table), len(df_data))
+        return result
+
+    @staticmethod
+    @Logged.unlogged
+    def _upsert(table, conn, keys, data_iter):
+        '''Pandas to_sql insert method writing all rows in one statement
+           with the price updated on conflict with the (symbol, date) key'''
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+        statement = sqlite_insert(table.table)
+        statement = statement.on_conflict_do_update(
+            index_elements=PRICE_KEY,
+            set_={PRICE: statement.excluded[PRICE]})
+        return conn.execute(statement, [dict(zip(keys, row))
+                                        for row in data_iter]).rowcount
+
+    @staticmethod
+    @Logged.unlogged
+    def _first_dates(data):
+        '''Earliest date of each symbol in storable price data'''
+        return data.groupby(SYMBOL)[DATE].min().to_dict()
+
+    @staticmethod
+    @Logged.unlogged
+    def _write_log(written):
+        '''INSERT_WRITE parameters of symbols and earliest dates written'''
+        return [{SYMBOL: symbol, FIRST_DATE: first_date}
+                for symbol, first_date in written.items()]
+
+    def _create_write_table(self):
+        '''Create price write log on first write'''
+        if not self._write_table:
+            with self._engine.begin() as conn:
+                conn.execute(text(CREATE_WRITE))
+            self._write_table = True
 
-    def _get_next_day(self, symbol):
+    def _has_write_table(self):
+        '''True once the price write log exists'''
+        if not self._write_table:
+            self._write_table = inspect(get_engine(
+                self._database, True)).has_table(DB_WRITE_TABLE)
+        return self._write_table
+
+    def _versioned(self, watermark, symbols=None):
+        '''Watermark with the write version of each symbol, NO_VERSION if
+           never written since the write log was created'''
+        versions = pandas.Series(dtype=int)
+        if self._has_write_table():
+            if symbols is None:
+                versions = self._get(SELECT_VERSION)
+            else:
+                versions = self._get(text(SELECT_VERSION_SYMBOLS).bindparams(
+                    bindparam(SYMBOLS, expanding=True)),
+                    {SYMBOLS: list(symbols)})
+            versions = versions.set_index(SYMBOL)[VERSION]
+        watermark[VERSION] = versions.reindex(watermark.index).fillna(
+            NO_VERSION).astype(int)
+        return watermark
+
+    def _get_watermark(self, symbol=None):
+        '''Last date, count and write version of prices indexed by symbol.
+           Every symbol is collected in one grouped query so callers looping
+           over the provider table should get it once and pass it on'''
+        if symbol is None:
+            query = SELECT_WATERMARK
+        else:
+            query = SELECT_WATERMARK_WHERE.format(symbol)
+        return self._versioned(self._get(query).set_index(SYMBOL),
+                               None if symbol is None else [symbol])
+
+    def watermark(self):
+        '''Last date, count and write version of prices for every symbol'''
+        return self._get_watermark()
+
+    def watermarks(self, symbols=None):
+        '''Dictionary of symbol to (last date, count, write version) that
+           results derived from prices are compared with to find changes.
+           Symbols given without prices are None'''
+        watermark = self.watermark()
+        result = {symbol: (str(last_date)[START:SLICE_DATE], int(count),
+                           int(version))
+                  for symbol, last_date, count, version in zip(
+                      watermark.index, watermark[LAST_DATE],
+                      watermark[COUNT], watermark[VERSION])}
+        if symbols is None:
+            return result
+        return {symbol: result.get(symbol) for symbol in symbols}
+
+    def _watermark_of(self, symbols):
+        '''Last date, count and write version of prices of symbols indexed
+           by symbol'''
+        query = text(SELECT_WATERMARK_SYMBOLS).bindparams(
+            bindparam(SYMBOLS, expanding=True))
+        return self._versioned(
+            self._get(query, {SYMBOLS: list(symbols)}).set_index(SYMBOL),
+            symbols)
+
+    def _written_since(self, symbol, version):
+        '''Earliest date written to symbol after version, None if the
+           write log has no later writes'''
+        if not self._has_write_table():
+            return None
+        result = self._get(text(SELECT_WRITTEN_SINCE),
+                           {SYMBOL: symbol, VERSION: int(version)})
+        return result[FIRST_DATE][START]
+
+    def _refresh_derived(self):
+        '''Extend snapshot and materialized returns with rows written by an
+           update. The watermark is read once and only symbols with new
+           prices are changed'''
+        watermark = self._get_watermark()
+        if self._snapshot is not None:
+            self._snapshot.refresh(self, watermark)
+        for period in MATERIALIZED_PERIODS:
+            self._materialize(list(watermark.index), period, watermark)
+
+    def _get_next_day(self, symbol, watermark=None):
         '''Utility function to determine date in database for any symbol and
-           then consequently next date to collect data to avoid duplicates.
-           Duplicates will cause the "pivot" operation in comparator to fail'''
-        result = self._get(SELECT_DATE.format(symbol))
-        next_day = pandas.to_datetime(result[DATE].max())
+           then consequently next date to collect data. Overlapping dates are
+           replaced by _set but starting after the last date keeps host
+           requests small'''
+        if watermark is None:
+            watermark = self._get_watermark(symbol)
+        if symbol not in watermark.index:
+            return None
+        next_day = pandas.to_datetime(watermark.at[symbol, LAST_DATE])
         if pandas.isnull(next_day):
             next_day = None
         else:
             # Collect next business day even if some prices (currencies...) are
             # quoted 24x7
+            from pandas.tseries.offsets import BDay
             next_day += BDay(NEXT_BUSINESS_DAY)
         return next_day
 
@@ -160,58 +580,113 @@ class Database(metaclass=Logged):
             result = self._get(SELECT_YAHOO)
         return result
 
-    def _where_comparators(self, comparison_set):
-        '''Select symbols for comparison'''
-        query = SELECT_COMPARISON.format(comparison_set)
-        result = self._get(query)
-        where_clause = " where "
-        for symbol in result[SYMBOL]:
-            where_clause = where_clause + "symbol='{}'".format(symbol) + " or "
-        where_clause = where_clause[:STRIP_OR_CLAUSE]
-        return where_clause
-
-    def comparators(self):
-        '''Comparators'''
-        result = self._get(SELECT_COMPARATORS)
-        for i in result.iterrows():
-            query = SELECT_PRICE + \
-                    self._where_comparators(i[TUPLE_VALUES][START])
-            prices = self._get(query)
-            pivot_data = prices.pivot(index=DATE, columns=SYMBOL,
-                                      values=PRICE)
-            pivot_data = pivot_data.dropna()
-            self.chart(i[TUPLE_VALUES][START], pivot_data)
+    def comparators(self, aligned=True, tolerance=None):
+        '''Comparators - chart every comparison group in one batch. Returns
+           list of futures of the chart messages'''
+        panels = self.comparator_panels(aligned, tolerance)
+        return self.charts((comparison, panel.reset_index())
+                           for comparison, panel in panels.items())
+
+    def comparator_panels(self, aligned=True, tolerance=None):
+        '''Prices of every comparison group from one query joining provider
+           and price. Returns dictionary of comparison to dataframe indexed
+           by datetime with a column per symbol. Aligned takes each price as
+           of later dates (see align) so groups with mixed frequencies
+           (monthly CPI with daily rates) are compared on every date once
+           all symbols have started, dropping dates where a price is older
+           than tolerance. Otherwise only dates where every symbol has a
+           price are kept'''
+        from align import align, EXACT
+        data = self.compact(self._get(SELECT_COMPARATOR_PRICES))
+        # Rows are in provider order so each symbol is one block of dates
+        series = {symbol: pandas.Series(prices[PRICE].values,
+                                        index=prices[DATE].values,
+                                        name=symbol)
+                  for symbol, prices in data.groupby(SYMBOL, sort=False,
+                                                     observed=True)}
+        groups = data[[COMPARISON, SYMBOL]].drop_duplicates()
+        result = {}
+        for comparison, symbols in groups.groupby(COMPARISON,
+                                                  sort=False)[SYMBOL]:
+            panel = align([series[symbol] for symbol in symbols],
+                          tolerance=tolerance if aligned else EXACT)
+            # Leading dates before every symbol has started are dropped
+            result[comparison] = panel.dropna()
+        return result
 
     @staticmethod
-    def _copy_columns(dataframe, symbol):
+    def _copy_columns(dataframe, symbol, compact=False):
         '''Standardise data from provider to copy it to the database. Data to
            be copied is date, symbol and price. To keep method simple only
            mapping Close to price and not Adj Close as well. This would make
            logic more complex to test for Close and Adj Close in dataframe and
-           difference is not very meaningful in current analyses'''
+           difference is not very meaningful in current analyses. Compact
+           keeps datetime64 dates and a categorical symbol (see compact)'''
         dataframe.reset_index(inplace=True)
         dataframe.rename(columns=COLUMN_MAP, inplace=True)
         dataframe.insert(COLUMN_LOCATION, SYMBOL, symbol)
 
-        # Copy only required dataframe columns and convert to short date (sd)
-        # by slicing off zeroes in the timestamp section (2017-09-01 00:00:00)
         result = dataframe[COPY_COLUMN].copy()
+        if compact:
+            return Database.compact(result, [symbol])
+        # Convert to short date (sd) by slicing off zeroes in the timestamp
+        # section (2017-09-01 00:00:00)
         result[DATE] = pandas.Series([str(sd)[START:SLICE_DATE]
                                       for sd in result[DATE]])
         return result
 
-    def _update_latest(self, data_provider):
+    @staticmethod
+    @Logged.unlogged
+    def compact(data, symbols=None, float32=False):
+        '''Compact copy of a price dataframe: symbol as a category whose codes
+           index symbols (default in order of appearance), date as datetime64
+           and price as float64 or float32. Other columns are kept as they
+           are. Pivots, joins and groupby on the codes avoid comparing strings
+           and a frame takes around a third of the memory (half again for
+           float32 prices, about 7 significant digits)'''
+        result = data.copy()
+        if SYMBOL in result:
+            categories = (pandas.unique(result[SYMBOL]) if symbols is None
+                          else list(dict.fromkeys(symbols)))
+            result[SYMBOL] = pandas.Categorical(result[SYMBOL],
+                                                categories=categories)
+        if DATE in result:
+            result[DATE] = pandas.to_datetime(result[DATE])
+        if PRICE in result:
+            result[PRICE] = result[PRICE].astype(FLOAT32 if float32
+                                                 else FLOAT64)
+        return result
+
+    @staticmethod
+    @Logged.unlogged
+    def _storable(data):
+        '''Price dataframe as stored: compact frames have datetime64 dates
+           and categorical symbols converted back to short date and text'''
+        if not pandas.api.types.is_datetime64_any_dtype(data[DATE]) and \
+                not isinstance(data[SYMBOL].dtype, pandas.CategoricalDtype):
+            return data
+        data = data.copy()
+        if pandas.api.types.is_datetime64_any_dtype(data[DATE]):
+            data[DATE] = data[DATE].dt.strftime(SHORT_DATE)
+        data[SYMBOL] = data[SYMBOL].astype(str)
+        if PRICE in data:
+            data[PRICE] = data[PRICE].astype(FLOAT64)
+        return data
+
+    def _update_latest(self, data_provider, watermark=None):
         '''Internal method to get latest data from host data providers and
            write it to the database'''
         symbols = self._get_host_symbols(data_provider)
+        if watermark is None:
+            watermark = self._get_watermark()
         for index, value in symbols.iterrows():
             symbol = value[SYMBOL]
-            next_day = self._get_next_day(symbol)
+            next_day = self._get_next_day(symbol, watermark)
             # Check if already have the latest data. Ideally data is collected
             # at weekends to avoid any duplication or incomplete data yahoo
             # seems to get previous business date (01-Sep-17) when requesting
             # a weekend date (02-Sep-17) so use next business day (04-Sep-17)
-            if next_day < pandas.to_datetime(TODAY):
+            if next_day is None or next_day < pandas.to_datetime(TODAY):
                 self._log.info("Index: %i Host: %s Symbol: %s Next day %s",
                                index + OFFSET_ZERO_START, data_provider,
                                symbol, next_day)
@@ -241,22 +716,210 @@ class Database(metaclass=Logged):
         # standardise output based on three columns (date, symbol, price)
         return self._copy_columns(result, symbol)
 
-    def update_all_symbols(self):
+    @Logged.histogram
+    def update_all_symbols(self, concurrent=False):
         '''Get latest data and write it to the database by iterating through
            the data providers (yahoo and quandl) and then the symbols for each
-           data provider'''
+           data provider. Concurrent uses update_concurrent defaults'''
+        if concurrent:
+            return self.update_concurrent()
         providers = self._get_provider()
+        watermark = self._get_watermark()
         for index, row in providers.iterrows():
             self._log.info("Host #%i Symbol: %s", index + OFFSET_ZERO_START,
                            row[HOST])
-            self._update_latest(row[HOST])
+            self._update_latest(row[HOST], watermark)
+        self._refresh_derived()
+
+    def _fetch(self, host, symbol, start_date, retries, backoff):
+        '''Get host data for one symbol retrying on any provider error.
+           Returns data and number of attempts taken. Runs in a worker thread
+           so there is no database access here'''
+        for attempt in range(1, retries + 1):
+            try:
+                return self.get_host_data(host, symbol, start_date), attempt
+            except Exception as exc:
+                if attempt == retries:
+                    raise
+                self._log.info("Retry %i for %s after: %r", attempt, symbol,
+                               exc)
+                time.sleep(backoff * 2 ** (attempt - 1))
+
+    def _write_batch(self, batch):
+        '''Write several symbols of host data in a single database write'''
+        if batch:
+            self._set(DB_PRICE_TABLE, pandas.concat(batch, ignore_index=True))
+        return []
+
+    @Logged.histogram
+    def update_concurrent(self, workers=None, retries=RETRY_ATTEMPTS,
+                          backoff=RETRY_BACKOFF, batch_size=WRITE_BATCH):
+        '''Get latest data for all symbols with requests to each host made
+           in parallel. Only host requests run in worker threads, database
+           reads are made up front and writes are batched in this thread.
+             workers - dictionary of host to maximum concurrent requests
+             retries - attempts per symbol before it is recorded as failed
+             backoff - seconds to wait after first failure, then doubled
+             batch_size - number of symbols written per database write
+           Returns summary dataframe (symbol, host, status, attempts, rows,
+           error) with one row per symbol in the provider table'''
+        workers = HOST_WORKERS if workers is None else workers
+        symbols = self._get(SELECT_SYMBOL_HOST)
+        watermark = self._get_watermark()
+        today = pandas.to_datetime(TODAY)
+        summary = []
+        pools = {}
+        futures = {}
+        for _, value in symbols.iterrows():
+            symbol, host = value[SYMBOL], value[HOST]
+            next_day = self._get_next_day(symbol, watermark)
+            if next_day is not None and next_day >= today:
+                summary.append([symbol, host, CURRENT, 0, 0, None])
+                continue
+            if host not in pools:
+                pools[host] = ThreadPoolExecutor(
+                    max_workers=workers.get(host, DEFAULT_WORKERS))
+            future = pools[host].submit(self._fetch, host, symbol, next_day,
+                                        retries, backoff)
+            futures[future] = (symbol, host)
+
+        batch = []
+        try:
+            for future in as_completed(futures):
+                symbol, host = futures[future]
+                try:
+                    result, attempts = future.result()
+                except Exception as exc:
+                    self._log.info("Failed host: %s Symbol: %s %r", host,
+                                   symbol, exc)
+                    summary.append([symbol, host, FAILED, retries, 0,
+                                    repr(exc)])
+                    continue
+                if result.empty:
+                    summary.append([symbol, host, EMPTY, attempts, 0, None])
+                    continue
+                summary.append([symbol, host, UPDATED, attempts,
+                                len(result), None])
+                batch.append(result)
+                if len(batch) >= batch_size:
+                    batch = self._write_batch(batch)
+            self._write_batch(batch)
+        finally:
+            for pool in pools.values():
+                pool.shutdown()
+
+        self._refresh_derived()
+        result = pandas.DataFrame(summary, columns=SUMMARY_COLUMN)
+        self._log.info("Concurrent update: %s",
+                       result[STATUS].value_counts().to_dict())
+        return result
+
+    @Logged.histogram
+    def bulk_load(self, frames, chunk_size=BULK_CHUNK):
+        '''Write an iterator of price dataframes (symbol, date, price) as
+           upserts in chunk_size row transactions with the BULK_PRAGMAS
+           SQLite settings. Frames are consumed as they arrive so only one
+           chunk is held in memory. Other databases use _set per frame.
+           Returns number of rows written'''
+        if self._engine.dialect.name != SQLITE:
+            rows = 0
+            for frame in frames:
+                self._set(DB_PRICE_TABLE, frame)
+                rows += len(frame)
+            return rows
+        self._create_write_table()
+        start = time.perf_counter()
+        written = {}
+        rows = 0
+        connection = self._engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            previous = {}
+            for pragma, value in BULK_PRAGMAS.items():
+                previous[pragma] = cursor.execute(
+                    PRAGMA_GET.format(pragma)).fetchone()[START]
+                cursor.execute(PRAGMA_SET.format(pragma, value))
+            try:
+                chunk = []
+                chunk_written = {}
+                for frame in frames:
+                    frame = self._storable(frame)
+                    for symbol, first_date in self._first_dates(
+                            frame).items():
+                        chunk_written[symbol] = min(
+                            first_date, chunk_written.get(symbol, first_date))
+                        written[symbol] = min(
+                            first_date, written.get(symbol, first_date))
+                    chunk.extend(frame[BULK_COLUMN].itertuples(index=False,
+                                                               name=None))
+                    if len(chunk) >= chunk_size:
+                        rows += self._write_chunk(connection, cursor, chunk,
+                                                  chunk_written)
+                        chunk = []
+                        chunk_written = {}
+                rows += self._write_chunk(connection, cursor, chunk,
+                                          chunk_written)
+            finally:
+                connection.rollback()
+                for pragma, value in previous.items():
+                    cursor.execute(PRAGMA_SET.format(pragma, value))
+        finally:
+            connection.close()
+            self._cache.invalidate(list(written))
+            if self._snapshot is not None:
+                self._snapshot.invalidate(written)
+        METRICS.observe(SQL_BULK, time.perf_counter() - start)
+        METRICS.count(ROWS_WRITTEN.format(DB_PRICE_TABLE), rows)
+        self._log.info("Bulk loaded %i rows for %i symbols", rows,
+                       len(written))
+        return rows
+
+    @staticmethod
+    @Logged.unlogged
+    def _write_chunk(connection, cursor, chunk, written):
+        '''Upsert rows (symbol, date, price) and log the symbols written
+           (symbol to earliest date) in one transaction'''
+        if chunk:
+            cursor.executemany(UPSERT_PRICE, chunk)
+            cursor.executemany(INSERT_WRITE, Database._write_log(written))
+            connection.commit()
+        return len(chunk)
+
+    @Logged.histogram
+    def backfill(self, symbols=None):
+        '''Reload the full history of symbols (default every symbol in the
+           provider table) from their hosts with bulk_load. Symbols that fail
+           or return no data are logged and skipped. Returns rows written'''
+        provider = self._get(SELECT_SYMBOL_HOST)
+        if symbols is not None:
+            provider = provider[provider[SYMBOL].isin(list(symbols))]
+
+        def frames():
+            '''Host data of each symbol as it is collected'''
+            for symbol, host in zip(provider[SYMBOL], provider[HOST]):
+                try:
+                    result = self.get_host_data(host, symbol, None)
+                except Exception as exc:
+                    self._log.info("Backfill failed host: %s Symbol: %s %r",
+                                   host, symbol, exc)
+                    continue
+                if result.empty:
+                    self._log.info("Backfill dataset empty for %s", symbol)
+                    continue
+                yield result
+
+        rows = self.bulk_load(frames())
+        self._refresh_derived()
+        return rows
 
     def update_symbol(self, provider, symbol):
         '''Update symbol'''
+        result = pandas.DataFrame()
         next_day = self._get_next_day(symbol)
-        if next_day < pandas.to_datetime(TODAY):
+        if next_day is None or next_day < pandas.to_datetime(TODAY):
             result = self.get_host_data(provider, symbol, next_day)
             self._set(DB_PRICE_TABLE, result)
+            self._refresh_derived()
             self._log.info("Updated %s from %s", symbol, next_day)
         else:
             self._log.info("Not updated %s Next date: %s", symbol, next_day)
@@ -268,103 +931,469 @@ class Database(metaclass=Logged):
            Changes are appended by default so results of latest changes can be
            seen based on most recent update'''
         symbols = self._get(SELECT_SYMBOL)
-        for index, value in symbols.iterrows():
-            latest = self._get(SELECT_DATE.format(value.symbol))
+        report = symbols.join(self._get_watermark(), on=SYMBOL)
+        report[LAST_DATE] = report[LAST_DATE].fillna("")
+        report[COUNT] = report[COUNT].fillna(0).astype(int)
+        for index, value in report.iterrows():
             self._log.info("Index: %i Symbol: %s Last Date: %s Count: %i",
                            index + OFFSET_ZERO_START,
                            value[SYMBOL],
-                           latest[DATE].max()[START:SLICE_DATE],
-                           latest.index.max() + OFFSET_ZERO_START)
+                           value[LAST_DATE][START:SLICE_DATE],
+                           value[COUNT])
+        return report
 
     @staticmethod
     def chart(title, chart_data):
-        '''Chart'''
-        charts = chart_data.plot(x=DATE, title=title,
-                                 figsize=(16, 10)).get_figure()
-        today = str(pandas.to_datetime(TODAY).date())
-        filename = SAVE_LOCATION + title + "_" + today + ".png"
-        charts.savefig(filename)
-        return "Saved chart to {}".format(filename)
+        '''Chart rendered on a worker process (see charts), skipped if the
+           same chart exists. Returns future of the saved chart message'''
+        from charts import renderer
+        return renderer().submit(title, chart_data)
+
+    @staticmethod
+    def charts(charts):
+        '''Render list of (title, data) charts, returns list of futures'''
+        from charts import renderer
+        return renderer().submit_all(charts)
 
     def resample(self, symbols, start_date=None, period=MONTH):
-        '''Resample daily data to monthly or similar'''
-        rtn = pandas.DataFrame()
-        for symbol in symbols:
-            # get_data expects a list of symbols
-            result = self.get_data([symbol], start_date)
-            result[DATE] = pandas.to_datetime(result[DATE])
-            result.set_index([DATE], inplace=True)
-
-            resampled = pandas.DataFrame()
-            resampled[PRICE] = result[PRICE].resample(period).last()
-            resampled.insert(COLUMN_LOCATION, SYMBOL, symbol)
-            # Convert to short date (sd) by slicing off zeroes in the
-            # timestamp section (2017-09-01 00:00:00)
-            resampled.reset_index(inplace=True)
-            resampled[DATE] = pandas.Series([str(sd)[START:SLICE_DATE]
-                                             for sd in resampled[DATE]])
-
-            if rtn.empty:
-                rtn = resampled
-                rtn = self.return_value(resampled)
+        '''Resample daily data to monthly or similar. Returns are read from
+           the materialized price_return table (extended after each update)
+           when it was built from the current prices of every symbol,
+           otherwise symbols are resampled together with resample_panel.
+           Only reads the database'''
+        symbols = list(symbols)
+        key = (RESAMPLE, tuple(symbols), start_date, period)
+        result = self._cache.get(key)
+        if result is None:
+            if self._returns_current(symbols, period):
+                result = self._select_returns(symbols, start_date, period)
             else:
-                resampled = self.return_value(resampled)
-                rtn = pandas.concat([rtn, resampled])
+                result = self.resample_panel(symbols, start_date,
+                                             [period])[period]
+            self._cache.set(key, result, symbols)
+        return result.copy()
 
-        return rtn
+    def _has_return_tables(self, engine=None):
+        '''True once the materialized return tables exist with a version
+           in their watermark (tables without it are rebuilt by update)'''
+        if not self._return_tables:
+            inspector = inspect(engine or get_engine(self._database, True))
+            self._return_tables = (
+                inspector.has_table(DB_RETURN_WATERMARK_TABLE) and
+                VERSION in [column["name"] for column in
+                            inspector.get_columns(DB_RETURN_WATERMARK_TABLE)])
+        return self._return_tables
+
+    def _returns_current(self, symbols, period):
+        '''True if the materialized returns of every symbol with prices
+           were built from its current price watermark and write version'''
+        if not symbols or not self._has_return_tables():
+            return False
+        watermark = self._watermark_of(symbols)
+        query = text(SELECT_RETURN_WATERMARK).bindparams(
+            bindparam(SYMBOLS, expanding=True))
+        held = self._get(query, {PERIOD: period, SYMBOLS: symbols})
+        held = held.set_index(SYMBOL).reindex(watermark.index)
+        return (held[LAST_DATE].equals(watermark[LAST_DATE]) and
+                all(held[column].fillna(-1).astype(int).equals(
+                    watermark[column].astype(int))
+                    for column in [COUNT, VERSION]))
+
+    def _select_returns(self, symbols, start_date=None, period=MONTH):
+        '''Materialized returns of symbols in the order requested. A start
+           date gives the returns as if resampled from the first price after
+           it, i.e. from the period holding that price'''
+        query = SELECT_RETURN
+        params = {PERIOD: period, SYMBOLS: symbols}
+        if start_date is None:
+            query += WHERE_RETURN_CHANGE
+        else:
+            query += WHERE_START_DATE
+            params[START_DATE] = str(start_date)
+        query = text(query + ORDER_SYMBOL_DATE).bindparams(
+            bindparam(SYMBOLS, expanding=True))
+        result = self._get(query, params)
+        # Keep symbols in the order requested as resample_panel
+        order = result[SYMBOL].map({symbol: index for index, symbol
+                                    in enumerate(symbols)})
+        result = result.iloc[numpy.argsort(order.values, kind="stable")]
+        result = result.reset_index(drop=True)
+        if start_date is not None:
+            first = self._get(text(SELECT_FIRST_DATE).bindparams(
+                bindparam(SYMBOLS, expanding=True)),
+                {SYMBOLS: symbols, START_DATE: str(start_date)})
+            starts = {symbol: str(pandas.Timestamp(date).to_period(period)
+                                  .end_time.date())
+                      for symbol, date in zip(first[SYMBOL],
+                                              first[FIRST_DATE])}
+            result = result[result[DATE] >= result[SYMBOL].map(starts)]
+            # As if resampled from start date, percent change starts a
+            # year of periods later and total return from there
+            result = result[(result.groupby(SYMBOL).cumcount() >=
+                             RETURN_PERIODS.get(period, ANNUAL)) &
+                            result[PCT_CHANGE].notnull()]
+            base = result.groupby(SYMBOL)[PRICE].transform(FIRST)
+            result[TOTAL_RETURN] = ((result[PRICE] / base - 1) *
+                                    PCT).mask(~result[SYMBOL].duplicated())
+            result = result.reset_index(drop=True)
+        return result
+
+    def _create_return_tables(self):
+        '''Create materialized return tables on first use, replacing
+           tables built before the watermark had a version'''
+        if not self._has_return_tables(self._engine):
+            with self._engine.begin() as conn:
+                for table in [DB_RETURN_TABLE, DB_RETURN_WATERMARK_TABLE]:
+                    conn.execute(text(DROP_TABLE.format(table)))
+                conn.execute(text(CREATE_RETURN))
+                conn.execute(text(CREATE_RETURN_WATERMARK))
+            self._return_tables = True
+
+    def _materialize(self, symbols, period=MONTH, watermark=None):
+        '''Bring materialized returns of symbols for period up to date with
+           the price table (watermark of the symbols). Symbols written since
+           (new or revised prices) are recalculated from the period holding
+           the earliest date written in the write log, so cost depends on
+           the rows written not history. Symbols changed without a write log
+           entry are rebuilt. Called from the update path only'''
+        self._create_return_tables()
+        return_period = RETURN_PERIODS.get(period, ANNUAL)
+        if watermark is None:
+            watermark = self._watermark_of(symbols)
+        query = text(SELECT_RETURN_WATERMARK).bindparams(
+            bindparam(SYMBOLS, expanding=True))
+        held = self._get(query, {PERIOD: period, SYMBOLS: symbols})
+        held = held.set_index(SYMBOL)
+        for symbol in symbols:
+            if symbol not in watermark.index:
+                continue
+            last_date = watermark.at[symbol, LAST_DATE]
+            count = int(watermark.at[symbol, COUNT])
+            version = int(watermark.at[symbol, VERSION])
+            result = None
+            if symbol in held.index:
+                held_version = int(held.at[symbol, VERSION])
+                if held.at[symbol, LAST_DATE] == last_date and \
+                        int(held.at[symbol, COUNT]) == count and \
+                        held_version == version:
+                    continue
+                if held_version != version:
+                    since = self._written_since(symbol, held_version)
+                    if since is not None:
+                        result = self._extend_returns(symbol, period,
+                                                      return_period, since)
+            if result is None:
+                prices = self._select_prices([symbol])
+                prices = pandas.Series(prices[PRICE].values,
+                                       index=pandas.to_datetime(prices[DATE]))
+                result = (ALL_DATES,
+                          self._returns(prices.resample(period).last(),
+                                        return_period))
+            self._write_returns(symbol, period, result, last_date, count,
+                                version)
+
+    def _extend_returns(self, symbol, period, return_period, since):
+        '''Returns from the period holding since (the earliest date
+           written) with the stored periods before it as context. Returns
+           (date to replace from, returns) or None if the symbol has to be
+           rebuilt'''
+        start = pandas.Timestamp(since).to_period(period).start_time
+        params = {SYMBOL: symbol, PERIOD: period, LIMIT: return_period + 2,
+                  DATE: str(start.date())}
+        context = self._get(text(SELECT_RETURN_TAIL), params)
+        if context.empty:
+            return None
+        context = pandas.Series(
+            context[PRICE].values[::-1],
+            index=pandas.to_datetime(context[DATE].values[::-1]))
+        prices = self._select_prices([symbol], str(context.index[-1].date()))
+        if prices.empty:
+            return None
+        prices = pandas.Series(prices[PRICE].values,
+                               index=pandas.to_datetime(prices[DATE]))
+        resampled = prices.resample(period).last()
+        combined = pandas.concat([context, resampled]).resample(period).last()
+
+        base = self._get(text(SELECT_RETURN_BASE), params)
+        if base.empty or pandas.to_datetime(base[DATE][START]) > \
+                context.index[-1]:
+            base = None
+        else:
+            base = base[PRICE][START]
+        result = self._returns(combined, return_period, base)
+        replace_after = str(context.index[-1].date())
+        return replace_after, result[result.index > context.index[-1]]
+
+    @staticmethod
+    @Logged.unlogged
+    def _returns(prices, return_period=ANNUAL, base=None):
+        '''Percent change and total return of one symbol's resampled prices
+           as in return_value, keeping rows without percent change. Total
+           return is measured from base, or the first row with a percent
+           change if there is no base'''
+        change = prices.ffill().pct_change(periods=return_period,
+                                           fill_method=None) * PCT
+        change = change.where(prices.notnull())
+        valid = change.notnull()
+        if base is None:
+            first = valid & (valid.cumsum() == 1)
+            base = prices[first].max()
+            total = ((prices / base - 1) * PCT).where(valid).mask(first)
+        else:
+            total = ((prices / base - 1) * PCT).where(valid)
+        return pandas.DataFrame({PRICE: prices, PCT_CHANGE: change,
+                                 TOTAL_RETURN: total})
+
+    def _write_returns(self, symbol, period, result, last_date, count,
+                       version):
+        '''Replace materialized returns after a date and record the price
+           watermark they were built from in one transaction'''
+        replace_after, returns = result
+        returns = returns.rename_axis(DATE).reset_index()
+        returns[DATE] = returns[DATE].dt.strftime(SHORT_DATE)
+        returns.insert(COLUMN_LOCATION, PERIOD, period)
+        returns.insert(COLUMN_LOCATION, SYMBOL, symbol)
+        with self._engine.begin() as conn:
+            conn.execute(text(DELETE_RETURN), {SYMBOL: symbol, PERIOD: period,
+                                               DATE: replace_after})
+            returns.to_sql(DB_RETURN_TABLE, conn, if_exists=DEFAULT_TO_APPEND,
+                           index=False)
+            conn.execute(text(UPSERT_RETURN_WATERMARK),
+                         {SYMBOL: symbol, PERIOD: period,
+                          LAST_DATE: last_date, COUNT: count,
+                          VERSION: version})
+        self._log.info("Materialized %i %s returns for %s", len(returns),
+                       period, symbol)
+
+    def resample_panel(self, symbols, start_date=None, periods=PERIODS,
+                       end_date=None):
+        '''Resample all symbols to each period and add return values. Data
+           is collected in one query and every symbol is resampled together
+           on a date x symbol panel with dates kept as datetime until output.
+           Returns dictionary of period to dataframe (date, symbol, price,
+           percent_change, total_return) ordered by symbol and date. Used
+           by resample for returns that are not materialized'''
+        symbols = list(symbols)
+        key = (RESAMPLE_PANEL, tuple(symbols), start_date, tuple(periods),
+               end_date)
+        result = self._cache.get(key)
+        if result is None:
+            panel = self._get_panel(symbols, start_date, end_date)
+            result = {}
+            for period in periods:
+                resampled = panel.resample(period).last()
+                result[period] = self._stack_returns(
+                    resampled, RETURN_PERIODS.get(period, ANNUAL))
+            self._cache.set(key, result, symbols)
+        # Copy so callers can change results without changing the cache
+        return {period: data.copy() for period, data in result.items()}
+
+    def _get_panel(self, symbols, start_date=None, end_date=None):
+        '''Wide date x symbol prices with datetime index, loaded from the
+           snapshot when it holds all the symbols'''
+        if self._snapshot is not None and self._snapshot.covers(symbols):
+            return self._snapshot.load(symbols, start_date, end_date,
+                                       wide=True)
+        return self.get_data(symbols, start_date, end_date, wide=True,
+                             compact=True)
+
+    @staticmethod
+    def _stack_returns(panel, return_period=ANNUAL):
+        '''Vectorised return_value for every column of a date x symbol panel
+           stacked to one row per date and symbol. As in return_value, dates
+           without a percent change are dropped and total return starts
+           from the first date with a percent change'''
+        if panel.empty:
+            return pandas.DataFrame(columns=RESAMPLE_COLUMN)
+        # Forward fill gaps as pct_change did by default (fill_method pad)
+        change = panel.ffill().pct_change(periods=return_period,
+                                          fill_method=None) * PCT
+        valid = change.notnull() & panel.notnull()
+        price = panel.where(valid)
+        # Total return compounds to price / first price (bfill gives first)
+        first = valid & (valid.cumsum() == 1)
+        total = ((price / price.bfill().iloc[START] - 1) * PCT).mask(first)
+
+        # Column major ravel orders the rows by symbol then date
+        mask = valid.values.ravel(order="F")
+        dates = numpy.tile(panel.index.values, len(panel.columns))[mask]
+        symbols = numpy.repeat(panel.columns.values, len(panel.index))[mask]
+        result = pandas.DataFrame({
+            DATE: pandas.DatetimeIndex(dates).strftime(SHORT_DATE),
+            SYMBOL: symbols,
+            PRICE: price.values.ravel(order="F")[mask],
+            PCT_CHANGE: change.values.ravel(order="F")[mask],
+            TOTAL_RETURN: total.values.ravel(order="F")[mask]},
+                                  columns=RESAMPLE_COLUMN)
+        return result
+
+    def momentum(self, symbols=None, horizons=HORIZONS, period=MONTH,
+                 end_date=None):
+        '''Percent change of each symbol (default all in provider) from
+           horizons periods ago to its last period up to end_date. All
+           horizons are taken together from one date x symbol panel with
+           prices carried forward over gaps. Returns dataframe indexed by
+           symbol with a column per horizon (3M, 6M...), NaN if the history
+           is shorter than the horizon'''
+        if symbols is None:
+            symbols = self._get(SELECT_SYMBOL)[SYMBOL]
+        symbols = list(symbols)
+        horizons = list(horizons)
+        key = (MOMENTUM, tuple(symbols), tuple(horizons), period, end_date)
+        result = self._cache.get(key)
+        if result is None:
+            panel = self._get_panel(symbols, end_date=end_date)
+            values = panel.resample(period).last().ffill().values
+            if not len(values):
+                values = numpy.full((1, len(panel.columns)), numpy.nan)
+            rows = len(values) - 1 - numpy.array(horizons)
+            past = values[numpy.maximum(rows, 0)]
+            past[rows < 0] = numpy.nan
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                change = (values[-1] / past - 1) * PCT
+            result = pandas.DataFrame(
+                change.T, index=pandas.Index(panel.columns, name=SYMBOL),
+                columns=[HORIZON_LABEL.format(horizon, period)
+                         for horizon in horizons])
+            self._cache.set(key, result, symbols)
+        return result.copy()
+
+    def direction(self, symbols=None, horizons=HORIZONS, period=MONTH,
+                  end_date=None):
+        '''Direction of momentum as small integers, 1 up, -1 down and 0
+           flat or unknown'''
+        change = self.momentum(symbols, horizons, period, end_date)
+        return numpy.sign(change.fillna(0)).astype(numpy.int8)
 
     @staticmethod
     def return_value(data, return_period=ANNUAL):
-        '''Return'''
-        result = pandas.DataFrame()
-        result = data
-        result[PCT_CHANGE] = data[PRICE].pct_change(
-            periods=return_period) * PCT
+        '''Return percent change over return_period rows and total return
+           as a new dataframe, data is not changed'''
+        result = data.assign(**{PCT_CHANGE: data[PRICE].pct_change(
+            periods=return_period) * PCT})
         # Drop NaN so that cumulative return start from correct date
-        result.dropna(inplace=True)
-        result[TOTAL_RETURN] = ((1 + data[PRICE].pct_change())
+        result = result.dropna()
+        result[TOTAL_RETURN] = ((1 + result[PRICE].pct_change())
                                 .cumprod() - 1) * PCT
         return result
 
-    def get_data(self, symbols, start_date=None):
-        '''Get symbol data from database and return a pandas dataframe with a
-           simple concatenation of the results
+    def get_data(self, symbols, start_date=None, end_date=None, wide=False,
+                 compact=False, float32=False):
+        '''Get symbol data from database in one query (or the snapshot) and
+           return a dataframe (symbol, date, price) ordered by symbol and date
              symbols - (must be) list of symbols to extract from database
-             start_date - filter out earlier dates i.e. 2016 or 2013-05'''
-        result = pandas.DataFrame()
-        for symbol in symbols:
-            query = SELECT_PRICE_WHERE.format(symbol)
-            dataframe = self._get(query)
-            if result.empty:
-                result = dataframe
-            else:
-                result.insert(COLUMN_LOCATION, SYMBOL, symbol)
-                result = pandas.concat([result, dataframe])
+             start_date - filter out earlier dates i.e. 2016 or 2013-05
+             end_date - filter out later dates i.e. 2017 (includes 2017)
+             wide - dataframe indexed by date with a column per symbol
+             compact - categorical symbol (codes in order of symbols) and
+                 datetime64 dates (see compact), wide has a datetime index
+             float32 - compact prices as float32'''
+        symbols = list(symbols)
+        key = (GET_DATA, tuple(symbols), start_date, end_date, wide, compact,
+               compact and float32)
+        result = self._cache.get(key)
+        if result is not None:
+            return result.copy()
+        if self._snapshot is not None and self._snapshot.covers(symbols):
+            result = self._snapshot.load(symbols, start_date, end_date)
+            if not compact:
+                result[DATE] = numpy.datetime_as_string(
+                    result[DATE].values.astype(DATE_DAY), unit=DAY)
+        else:
+            result = self._select_prices(symbols, start_date, end_date)
+        if compact:
+            result = self.compact(result, symbols, float32)
+
+        if wide:
+            result = result.pivot(index=DATE, columns=SYMBOL, values=PRICE)
+            result = result.reindex(columns=symbols)
+        self._cache.set(key, result, symbols)
+        return result.copy()
+
+    def _select_prices(self, symbols, start_date=None, end_date=None):
+        '''Prices for all symbols in one parameterised query with dates
+           filtered in SQL'''
+        query = SELECT_PRICE_SYMBOLS
+        params = {SYMBOLS: symbols}
         if start_date is not None:
-            result = result[result[DATE] > start_date]
+            query += WHERE_START_DATE
+            params[START_DATE] = str(start_date)
+        if end_date is not None:
+            # Last day of the period so 2017 or 2017-06 include that period
+            query += WHERE_END_DATE
+            params[END_DATE] = str(pandas.Period(str(end_date))
+                                   .end_time)[START:SLICE_DATE]
+        query = text(query + ORDER_SYMBOL_DATE).bindparams(
+            bindparam(SYMBOLS, expanding=True))
+        return self._get(query, params)
 
-        return result
+    def invalidate(self, symbols=None):
+        '''Forget cached results (and snapshot arrays) of symbols, default
+           all, e.g. when prices were written by another process'''
+        self._cache.invalidate(symbols)
+        if self._snapshot is not None and symbols is not None:
+            self._snapshot.invalidate(symbols)
+
+    def cache_stats(self):
+        '''Cache statistics (hits, misses, evictions...) to tune cache_size'''
+        return self._cache.stats()
 
-    def real_return(self, long_bond, inflation, start_date=None):
+    def real_return(self, long_bond, inflation, start_date=None,
+                    tolerance=REAL_RETURN_TOLERANCE):
         '''Real return = long bond - inflation
            Start date will be one year before actual data to start the cycle
-           for 12 month or annual inflation'''
-        bond = self.resample([long_bond], start_date)
-        cpi = self.get_data([inflation], start_date)
-        annual_cpi = self.return_value(cpi)
-        bond = bond[[DATE, PRICE]]
-        annual_cpi = annual_cpi[[DATE, PCT_CHANGE]]
-        real_rate = self.concatenate(bond, annual_cpi)
+           for 12 month or annual inflation. Bond and annual inflation are
+           taken as of each date (see align) so the latest bond price is
+           compared to the last inflation print within tolerance'''
+        from align import align
+        # Monthly CPI resampled to month end to use materialized returns
+        data = self.resample([long_bond, inflation], start_date)
+        bond = data[data[SYMBOL] == long_bond][[DATE, PRICE]]
+        annual_cpi = data[data[SYMBOL] == inflation][[DATE, PCT_CHANGE]]
+        real_rate = align([bond, annual_cpi], tolerance=tolerance)
         real_rate[REAL_RETURN] = real_rate[PRICE] - real_rate[PCT_CHANGE]
+        real_rate.index = real_rate.index.strftime(SHORT_DATE)
+        real_rate.reset_index(inplace=True)
         self._log.info(real_rate)
         return real_rate
 
+    def real_return_panel(self, pairs, start_date=None,
+                          tolerance=REAL_RETURN_TOLERANCE):
+        '''Real return (long bond - annual inflation) of every name in pairs
+           dictionary of name to (bond, cpi) in one pass. All symbols are
+           resampled together and aligned as of the union of their dates as
+           real_return gives for one pair, then bond prices less CPI percent
+           changes are taken over the date x pair arrays. Returns dataframe
+           indexed by date with a column per name'''
+        from align import align
+        names = list(pairs)
+        bonds = [pairs[name][START] for name in names]
+        cpis = [pairs[name][COLUMN] for name in names]
+        data = self.resample(list(dict.fromkeys(bonds + cpis)), start_date)
+        data = data.set_index(pandas.to_datetime(data[DATE]))
+        empty = data.iloc[:START]
+        held = dict(list(data.groupby(SYMBOL, sort=False)))
+        aligned = align([held.get(bond, empty)[PRICE] for bond in bonds] +
+                        [held.get(cpi, empty)[PCT_CHANGE] for cpi in cpis],
+                        tolerance=tolerance)
+        values = aligned.values
+        result = pandas.DataFrame(values[:, :len(names)] -
+                                  values[:, len(names):],
+                                  index=aligned.index.strftime(SHORT_DATE),
+                                  columns=names)
+        result.index.name = DATE
+        return result
+
+    def real_return_pairs(self):
+        '''Dictionary of country to (bond, cpi) from the 10Year and
+           Inflation comparison groups of the provider table'''
+        result = self._get(SELECT_REAL_RETURN_PAIRS)
+        return {country: (bond, cpi) for country, bond, cpi
+                in zip(result[COUNTRY], result[BOND], result[CPI])}
+
     @staticmethod
     def concatenate(source, target):
-        '''Concatenate'''
-        source.set_index(DATE, inplace=True)
-        target.set_index(DATE, inplace=True)
-        result = pandas.concat([source, target], axis=COLUMN)
-        result.reset_index(inplace=True)
-        result.rename(columns={RESET_INDEX_NAME: DATE}, inplace=True)
-        return result
+        '''Outer join of two dataframes on their date column, inputs are not
+           changed. Only rows with the same date are joined, use align to
+           join series of different frequencies as of each date'''
+        return pandas.merge(source, target, on=DATE, how=OUTER, sort=True)
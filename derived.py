@@ -0,0 +1,223 @@
+'''
+Dependency graph of derived series and charts. Each node records the raw
+symbols it reads and the nodes it uses, so its inputs are the price
+watermarks (last date, count and write version) of every symbol it depends
+on directly or through other nodes. After an update only nodes whose
+watermarks changed (new or revised prices) are recomputed, along with any
+node they use whose result is not held.
+Nodes in the same level of the graph do not depend on each other and are
+evaluated in parallel threads. Watermarks can be kept in a state file so a
+later run only recomputes what changed since
+'''
+import json
+from concurrent.futures import ThreadPoolExecutor
+import pandas
+from database import DATE, REAL_RETURN
+from returns import Returns, REAL_RETURN_PAIRS, COUNTRY, COMPARE_REAL_RETURNS
+from rnl_util import Logged
+
+GRAPH_WORKERS = 4
+START_DATE = "2015"
+# Node status after update
+COMPUTED = "computed"
+CURRENT = "current"
+FAILED = "failed"
+SKIPPED = "skipped"
+UNKNOWN_NODE = "Unknown node {} used by {}"
+CYCLE = "Dependency cycle between {}"
+
+
+class Node(object):
+    '''Derived output computed by compute(database, inputs) where inputs is
+       a dictionary of the results of the nodes it depends on'''
+    def __init__(self, name, compute, symbols=(), depends=()):
+        '''Initialise node'''
+        self.name = name
+        self.compute = compute
+        self.symbols = list(symbols)
+        self.depends = list(depends)
+
+
+class DerivedGraph(metaclass=Logged):
+    '''Derived series and charts with the raw symbols they depend on.
+       Public methods:
+           add - add a node computed from symbols and other nodes
+           symbols - every raw symbol a node depends on
+           stale - nodes whose symbols have changed since computed
+           update - recompute stale nodes, independent nodes in parallel
+           result - last result of a node'''
+    def __init__(self, database, workers=GRAPH_WORKERS, state=None):
+        '''Initialise graph with a Database. State is a JSON file keeping
+           the watermarks each node was last computed from'''
+        self._data = database
+        self._workers = workers
+        self._state = state
+        self._nodes = {}
+        self._results = {}
+        self._held = {}
+        self._log = Logged.logger(__name__)
+        if state is not None:
+            try:
+                with open(state) as state_file:
+                    self._held = json.load(state_file)
+            except FileNotFoundError:
+                pass
+
+    def add(self, name, compute, symbols=(), depends=()):
+        '''Add node computed by compute(database, inputs) from raw symbols
+           and the results of the depends nodes. Returns name'''
+        self._nodes[name] = Node(name, compute, symbols, depends)
+        return name
+
+    def symbols(self, name):
+        '''Raw symbols read by node and every node it depends on'''
+        node = self._nodes[name]
+        result = set(node.symbols)
+        for depend in node.depends:
+            result.update(self.symbols(depend))
+        return result
+
+    def _levels(self):
+        '''Node names in levels where every node only depends on nodes in
+           earlier levels'''
+        remaining = {}
+        for name, node in self._nodes.items():
+            for depend in node.depends:
+                if depend not in self._nodes:
+                    raise KeyError(UNKNOWN_NODE.format(depend, name))
+            remaining[name] = set(node.depends)
+        levels = []
+        while remaining:
+            level = [name for name, depends in remaining.items()
+                     if not depends]
+            if not level:
+                raise ValueError(CYCLE.format(sorted(remaining)))
+            for name in level:
+                del remaining[name]
+            for depends in remaining.values():
+                depends.difference_update(level)
+            levels.append(level)
+        return levels
+
+    def _watermark(self):
+        '''Last date, count and write version of every symbol as JSON
+           friendly lists'''
+        return {symbol: list(value)
+                for symbol, value in self._data.watermarks().items()}
+
+    def _inputs(self, name, watermark):
+        '''Watermarks of the symbols node depends on, None if no prices'''
+        return {symbol: watermark.get(symbol)
+                for symbol in sorted(self.symbols(name))}
+
+    def stale(self, watermark=None):
+        '''Names of nodes not computed from the current watermarks'''
+        watermark = self._watermark() if watermark is None else watermark
+        return [name for name in self._nodes
+                if self._held.get(name) != self._inputs(name, watermark)]
+
+    def _needed(self, stale, levels):
+        '''Stale nodes and the nodes they use whose result is not held,
+           e.g. in a new process with watermarks from the state file'''
+        needed = set(stale)
+        for level in reversed(levels):
+            for name in level:
+                if name in needed:
+                    needed.update(depend for depend
+                                  in self._nodes[name].depends
+                                  if depend not in self._results)
+        return needed
+
+    def _compute(self, name):
+        '''Compute node from the results of the nodes it depends on'''
+        node = self._nodes[name]
+        inputs = {depend: self._results[depend] for depend in node.depends}
+        return node.compute(self._data, inputs)
+
+    @Logged.histogram
+    def update(self):
+        '''Recompute stale nodes level by level, nodes in a level in
+           parallel. Nodes using a failed node are skipped and stay stale.
+           Returns dictionary of node name to status'''
+        watermark = self._watermark()
+        levels = self._levels()
+        stale = self.stale(watermark)
+        # Cached prices of symbols written since (maybe by another process)
+        changed = {symbol for name in stale for symbol, value
+                   in self._inputs(name, watermark).items()
+                   if self._held.get(name, {}).get(symbol) != value}
+        if changed:
+            self._data.invalidate(changed)
+        needed = self._needed(stale, levels)
+        status = {name: CURRENT for name in self._nodes}
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            for level in levels:
+                futures = {}
+                for name in level:
+                    if name not in needed:
+                        continue
+                    if any(status[depend] in (FAILED, SKIPPED)
+                           for depend in self._nodes[name].depends):
+                        status[name] = SKIPPED
+                        continue
+                    futures[name] = pool.submit(self._compute, name)
+                for name, future in futures.items():
+                    try:
+                        self._results[name] = future.result()
+                    except Exception as exc:
+                        self._log.info("Derived %s failed: %r", name, exc)
+                        self._held.pop(name, None)
+                        status[name] = FAILED
+                        continue
+                    self._held[name] = self._inputs(name, watermark)
+                    status[name] = COMPUTED
+        self._save()
+        self._log.info("Derived update: %s", ", ".join(
+            "{} {}".format(name, value) for name, value in status.items()
+            if value != CURRENT) or CURRENT)
+        return status
+
+    def _save(self):
+        '''Write watermarks of computed nodes to the state file'''
+        if self._state is not None:
+            with open(self._state, "w") as state_file:
+                json.dump(self._held, state_file, indent=1, sort_keys=True)
+
+    def result(self, name):
+        '''Last result of node, computing it (and its inputs) if not held'''
+        if name not in self._results:
+            inputs = {depend: self.result(depend)
+                      for depend in self._nodes[name].depends}
+            self._results[name] = self._nodes[name].compute(self._data,
+                                                            inputs)
+        return self._results[name]
+
+
+def _real(country, bond, cpi, start_date):
+    '''Node computing and charting real return of one country'''
+    return lambda data, inputs: Returns(data).real(country, bond, cpi,
+                                                   start_date)
+
+
+def _compare(data, inputs):
+    '''Node comparing real returns of each country and charting them'''
+    compared = pandas.concat(list(inputs.values()))
+    pivot = compared.pivot(index=DATE, columns=COUNTRY, values=REAL_RETURN)
+    pivot.reset_index(inplace=True)
+    data.chart(COMPARE_REAL_RETURNS, pivot)
+    return pivot
+
+
+def real_return_graph(database, pairs=None, start_date=START_DATE,
+                      workers=GRAPH_WORKERS, state=None):
+    '''Graph of the real return (and chart) of each name in pairs of name to
+       (bond, cpi), default REAL_RETURN_PAIRS, and the chart comparing
+       them, so a new CPI print only recomputes that country and the
+       comparison'''
+    pairs = REAL_RETURN_PAIRS if pairs is None else pairs
+    graph = DerivedGraph(database, workers, state)
+    countries = [graph.add(name, _real(name, bond, cpi, start_date),
+                           symbols=[bond, cpi])
+                 for name, (bond, cpi) in pairs.items()]
+    graph.add(COMPARE_REAL_RETURNS, _compare, depends=countries)
+    return graph
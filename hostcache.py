@@ -0,0 +1,161 @@
+'''
+Caching host layer. Raw host responses are kept on disk (a pickle of the
+dataframe as returned by Quandl or Yahoo) by host and symbol with the date
+range they cover. A request starting inside the held range is served from
+disk and only the tail after the last held date is fetched, at most once per
+max_age. Offline mode never calls the host so updates, analytics and
+benchmarks can be replayed without network access
+'''
+import os
+import json
+import threading
+from urllib.parse import quote
+import pandas
+from database import Host, QUANDL_DATA_PROVIDER, YAHOO_DATA_PROVIDER, \
+    SLICE_DATE, START
+from rnl_util import Logged
+
+HOST_CACHE_LOCATION = "host_cache"
+MANIFEST_FILE = "manifest.json"
+RESPONSE_FILE = "{}.{}.pkl"
+TEMP_FILE = "{}.tmp"
+# Held range of each response, start is None for full history
+RANGE_START = "start"
+RANGE_END = "end"
+FETCHED = "fetched"
+MAX_AGE = pandas.Timedelta(hours=12)
+NEXT_DAY = pandas.Timedelta(days=1)
+KEY_SEPARATOR = ":"
+KEY = "{}" + KEY_SEPARATOR + "{}"
+OFFLINE_MISS = "Offline and no cached {} data for {} from {}"
+
+
+class CachingHost(metaclass=Logged):
+    '''Host with responses cached on disk. Wraps a Host (or any object with
+       the same get_ methods) and is used in its place by Database.
+       Public methods:
+           get_quandl - Quandl data from cache, fetching the missing tail
+           get_yahoo - Yahoo data from cache, fetching the missing tail
+           get_csv - CSV file from the wrapped host (not cached)
+           invalidate - forget cached responses of symbols'''
+    def __init__(self, host=None, location=HOST_CACHE_LOCATION,
+                 offline=False, max_age=MAX_AGE):
+        '''Initialise cache directory and read manifest. Offline serves only
+           cached data and raises LookupError if a request is not held'''
+        self._host = Host() if host is None else host
+        self._location = location
+        self._offline = offline
+        self._max_age = pandas.Timedelta(max_age)
+        self._lock = threading.Lock()
+        self._log = Logged.logger(__name__)
+        os.makedirs(location, exist_ok=True)
+        try:
+            with open(self._path(MANIFEST_FILE)) as manifest:
+                self._manifest = json.load(manifest)
+        except FileNotFoundError:
+            self._manifest = {}
+
+    def _path(self, filename):
+        '''Full path of file in cache location'''
+        return os.path.join(self._location, filename)
+
+    def _filename(self, host, symbol):
+        '''Response file of symbol'''
+        return self._path(RESPONSE_FILE.format(host, quote(symbol, safe="")))
+
+    def _write_manifest(self):
+        '''Replace manifest in one step, called holding the lock'''
+        temp = self._path(TEMP_FILE.format(MANIFEST_FILE))
+        with open(temp, "w") as manifest:
+            json.dump(self._manifest, manifest, indent=1, sort_keys=True)
+        os.replace(temp, self._path(MANIFEST_FILE))
+
+    def _save(self, host, symbol, data, held):
+        '''Write response then manifest so it never points ahead'''
+        filename = self._filename(host, symbol)
+        data.to_pickle(TEMP_FILE.format(filename))
+        os.replace(TEMP_FILE.format(filename), filename)
+        with self._lock:
+            self._manifest[KEY.format(host, symbol)] = held
+            self._write_manifest()
+
+    @staticmethod
+    @Logged.unlogged
+    def _date(value):
+        '''Short date string of date or None'''
+        if value is None:
+            return None
+        return str(pandas.Timestamp(value))[START:SLICE_DATE]
+
+    @staticmethod
+    @Logged.unlogged
+    def _end(data, end=None):
+        '''Last date of response data or end if there is none'''
+        if data.empty:
+            return end
+        return CachingHost._date(data.index.max())
+
+    def _get(self, host, fetch, symbol, start_date):
+        '''Cached response of symbol from start_date. Held data is used when
+           it starts on or before start_date, the tail after the last held
+           date is fetched if older than max_age. Otherwise the full range
+           is fetched and replaces the held data'''
+        start = self._date(start_date)
+        held = self._manifest.get(KEY.format(host, symbol))
+        covered = held is not None and (
+            held[RANGE_START] is None or
+            (start is not None and start >= held[RANGE_START]))
+        now = pandas.Timestamp.now()
+        if covered:
+            data = pandas.read_pickle(self._filename(host, symbol))
+            stale = now - pandas.Timestamp(held[FETCHED]) > self._max_age
+            if stale and not self._offline:
+                # Nothing held yet (empty response) fetches the whole range
+                tail_start = held[RANGE_START]
+                if held[RANGE_END] is not None:
+                    tail_start = pandas.Timestamp(held[RANGE_END]) + NEXT_DAY
+                tail = fetch(symbol, tail_start)
+                if not tail.empty:
+                    data = pandas.concat([data, tail])
+                    data = data[~data.index.duplicated(keep="last")]
+                held = {RANGE_START: held[RANGE_START],
+                        RANGE_END: self._end(data, held[RANGE_END]),
+                        FETCHED: str(now)}
+                self._save(host, symbol, data, held)
+                self._log.info("Fetched %i %s rows from %s for %s",
+                               len(tail), host, self._date(tail_start),
+                               symbol)
+        elif self._offline:
+            raise LookupError(OFFLINE_MISS.format(host, symbol, start))
+        else:
+            data = fetch(symbol, start_date)
+            self._save(host, symbol, data, {RANGE_START: start,
+                                            RANGE_END: self._end(data),
+                                            FETCHED: str(now)})
+        if start is not None:
+            data = data[data.index >= pandas.Timestamp(start)]
+        return data
+
+    def get_quandl(self, symbol, start_date=None):
+        '''Quandl data for symbol from start_date'''
+        return self._get(QUANDL_DATA_PROVIDER, self._host.get_quandl, symbol,
+                         start_date)
+
+    def get_yahoo(self, symbol, start_date=None):
+        '''Yahoo data for symbol from start_date'''
+        return self._get(YAHOO_DATA_PROVIDER, self._host.get_yahoo, symbol,
+                         start_date)
+
+    def get_csv(self, filename):
+        '''CSV file from the wrapped host'''
+        return self._host.get_csv(filename)
+
+    def invalidate(self, symbols=None):
+        '''Forget cached responses of symbols (default all) so the next
+           request fetches the full range'''
+        with self._lock:
+            for key in list(self._manifest):
+                symbol = key.split(KEY_SEPARATOR, 1)[1]
+                if symbols is None or symbol in symbols:
+                    del self._manifest[key]
+            self._write_manifest()
@@ -1,22 +1,176 @@
-'''Main'''
-# from database import Database
-from returns import Returns
+'''Main - command line entry point
 
+    python main.py update [--concurrent]
+    python main.py backfill [--symbols ^FTAS ^GSPC]
+    python main.py report
+    python main.py real-returns [--start-date 2010] [--provider-pairs]
+    python main.py comparators
+    python main.py derived [--state derived.json] - recompute real returns
+        and charts whose symbols have new prices since the last run
+    python main.py startup [--budget 2.0]
+    python main.py serve [--port 8000] - read only HTTP query service
+    python main.py --metrics metrics.json <command> - write run metrics
+    python main.py --host-cache host_cache [--offline] <command> - cache
+        host responses on disk and (offline) replay them without network
 
-def main():
-    '''Main'''
+Modules are imported by each command so --help and commands that only read
+the database do not import provider clients (quandl, pandas_datareader) or
+matplotlib. startup measures the import time of a read command in a fresh
+interpreter and fails if it is over budget or loads provider clients
+(test_price.py runs it)'''
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+DEFAULT_DB = "sqlite:///prices.db"
+START_DATE = "2010"
+DERIVED_STATE = "derived.json"
+# Seconds allowed to import the modules used by read commands
+STARTUP_BUDGET = 2.0
+STARTUP_IMPORT = ("import sys, database, returns; "
+                  "print(','.join(sorted(name for name in {} "
+                  "if name in sys.modules)))")
+PROVIDER_MODULES = ["quandl", "pandas_datareader", "matplotlib"]
+
+
+def _database(args, read_only=False):
+    '''Database with host responses cached if --host-cache is given'''
+    from database import Database
+    host = None
+    if args.host_cache:
+        from hostcache import CachingHost
+        host = CachingHost(location=args.host_cache, offline=args.offline)
+    return Database(args.database, host=host, read_only=read_only)
+
+
+def update(args):
+    '''Get latest host data for every symbol in the provider table'''
+    data = _database(args)
+    if args.concurrent:
+        print(data.update_concurrent())
+    else:
+        data.update_all_symbols()
+
+
+def backfill(args):
+    '''Reload full history of symbols (default all) with the bulk loader'''
+    print(_database(args).backfill(args.symbols))
+
+
+def report(args):
+    '''Last date and count for every symbol in the provider table'''
+    print(_database(args).report())
+
+
+def real_returns(args):
+    '''Compare real returns on 10 year bonds'''
+    from returns import Returns
+    rtn = Returns(_database(args))
+    pairs = rtn.provider_pairs() if args.provider_pairs else None
+    print(rtn.compare_real_returns(start_date=args.start_date, pairs=pairs))
+
+
+def comparators(args):
+    '''Chart each comparison group in the provider table'''
+    _database(args).comparators()
+
+
+def derived(args):
+    '''Recompute derived series and charts whose symbols have changed'''
+    from derived import real_return_graph
+    graph = real_return_graph(_database(args), start_date=args.start_date,
+                              state=args.state)
+    print(graph.update())
 
-    # Collect data (last = 24-Sep-17)
-    # data = Database()
-    # data.report()
-    # data.update_all_symbols()
-    # print(data.comparators())
 
-    # Collect real return data
-    rtn = Returns()
-    result = rtn.compare_real_returns(start_date="2010")
-    # print(rtn.country_assets())
-    print(result)
+def serve(args):
+    '''Serve prices, returns and comparators over HTTP until interrupted'''
+    from service import serve as serve_http
+    serve_http(_database(args, read_only=True), args.host, args.port)
+
+
+def startup(args):
+    '''Time imports for a read command in a new interpreter. Returns exit
+       status 1 if over budget or provider modules were imported'''
+    query = STARTUP_IMPORT.format(PROVIDER_MODULES)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", query], check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    elapsed = time.perf_counter() - start
+    loaded = result.stdout.strip()
+    print("Startup {:.3f}s (budget {:.3f}s) provider modules: {}".format(
+        elapsed, args.budget, loaded or "none"))
+    return int(elapsed > args.budget or bool(loaded))
+
+
+def parser():
+    '''Command line arguments with a sub-command for each task'''
+    main_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    main_parser.add_argument("--database", default=DEFAULT_DB,
+                             help="SQLAlchemy database URL")
+    main_parser.add_argument("--metrics",
+                             help="write call and I/O metrics to JSON file")
+    main_parser.add_argument("--host-cache",
+                             help="directory to cache host responses")
+    main_parser.add_argument("--offline", action="store_true",
+                             help="only use cached host responses")
+    commands = main_parser.add_subparsers(dest="command")
+    commands.required = True
+
+    command = commands.add_parser("update", help=update.__doc__)
+    command.add_argument("--concurrent", action="store_true",
+                         help="parallel host requests")
+    command.set_defaults(func=update)
+
+    command = commands.add_parser("backfill", help=backfill.__doc__)
+    command.add_argument("--symbols", nargs="+")
+    command.set_defaults(func=backfill)
+
+    command = commands.add_parser("report", help=report.__doc__)
+    command.set_defaults(func=report)
+
+    command = commands.add_parser("real-returns", help=real_returns.__doc__)
+    command.add_argument("--start-date", default=START_DATE)
+    command.add_argument("--provider-pairs", action="store_true",
+                         help="every country in the provider table")
+    command.set_defaults(func=real_returns)
+
+    command = commands.add_parser("comparators", help=comparators.__doc__)
+    command.set_defaults(func=comparators)
+
+    command = commands.add_parser("derived", help=derived.__doc__)
+    command.add_argument("--start-date", default=START_DATE)
+    command.add_argument("--state", default=DERIVED_STATE,
+                         help="JSON file of watermarks last computed from")
+    command.set_defaults(func=derived)
+
+    command = commands.add_parser("serve", help=serve.__doc__)
+    command.add_argument("--host", default="127.0.0.1")
+    command.add_argument("--port", type=int, default=8000)
+    command.set_defaults(func=serve)
+
+    command = commands.add_parser("startup", help="check import time budget")
+    command.add_argument("--budget", type=float, default=STARTUP_BUDGET)
+    command.set_defaults(func=startup)
+    return main_parser
+
+
+def main(argv=None):
+    '''Main'''
+    args = parser().parse_args(argv)
+    try:
+        return args.func(args)
+    finally:
+        if "charts" in sys.modules:
+            # Wait for charts still rendering in the background
+            sys.modules["charts"].renderer().shutdown()
+        if args.metrics:
+            from rnl_util import METRICS
+            METRICS.export(args.metrics)
+
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
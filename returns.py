@@ -1,8 +1,9 @@
 '''
 Price handler for reporting and updating the database of prices
 '''
-import pandas
-from database import Database, DATE, REAL_RETURN, COLUMN_LOCATION, TOTAL_RETURN
+from database import Database, DATE, REAL_RETURN, COLUMN_LOCATION, \
+    TOTAL_RETURN, SHORT_DATE, REAL_RETURN_TOLERANCE
+from align import align
 from rnl_util import Logged
 
 START_DATE = "2015"
@@ -19,6 +20,7 @@ US_REAL_RETURN = "US Real Return"
 UK_REAL_RETURN = "UK Real Return"
 EUR_REAL_RETURN = "EUR Real Return"
 JPN_REAL_RETURN = "Japan Real Return"
+COUNTRY_REAL_RETURN = "{} Real Return"
 # 10 Year bonds
 TEN_YEAR_US = "FRED/DGS10"
 TEN_YEAR_UK = "BOE/IUDMNPY"
@@ -29,6 +31,11 @@ CPI_US = "RATEINF/CPI_USA"
 CPI_UK = "RATEINF/CPI_GBR"
 CPI_EUR = "RATEINF/CPI_EUR"
 CPI_JPN = "RATEINF/CPI_JPN"
+# Real returns compared by default, any number of (bond, cpi) pairs
+REAL_RETURN_PAIRS = {US_REAL_RETURN: (TEN_YEAR_US, CPI_US),
+                     UK_REAL_RETURN: (TEN_YEAR_UK, CPI_UK),
+                     EUR_REAL_RETURN: (TEN_YEAR_EUR, CPI_EUR),
+                     JPN_REAL_RETURN: (TEN_YEAR_JPN, CPI_JPN)}
 # Major share indices and All Country World Index (ACWI)
 INDEX_UK = "^FTAS"
 INDEX_JAPAN = "^N225"
@@ -48,9 +55,9 @@ CPI = [CPI_US, CPI_UK, CPI_JPN, CPI_EUR]
 
 class Returns(metaclass=Logged):
     '''Price'''
-    def __init__(self):
-        '''Init'''
-        self._data = Database()
+    def __init__(self, data=None):
+        '''Init with an existing Database to share its connection and cache'''
+        self._data = Database() if data is None else data
         self._log = Logged.logger(__name__)
 
     def real(self, country=US_REAL_RETURN, bond=TEN_YEAR_US, cpi=CPI_US,
@@ -59,27 +66,35 @@ class Returns(metaclass=Logged):
         result = self._data.real_return(bond, cpi, start_date)
         result = result[[DATE, REAL_RETURN]]
         result.insert(COLUMN_LOCATION, COUNTRY, country)
-        self._log.info(self._data.chart(country, result))
+        # Same chart data as compare_real_returns so it is drawn once
+        self._data.chart(country, result.dropna().reset_index(drop=True))
         return result
 
-    def compare_real_returns(self, start_date=START_DATE):
-        '''Compare'''
-        # US real return
-        us_rtn = self.real(US_REAL_RETURN, TEN_YEAR_US, CPI_US, start_date)
-        # UK real return
-        uk_rtn = self.real(UK_REAL_RETURN, TEN_YEAR_UK, CPI_UK, start_date)
-        # EUR real return
-        eur_rtn = self.real(EUR_REAL_RETURN, TEN_YEAR_EUR, CPI_EUR, start_date)
-        # Japan real return
-        jpn_rtn = self.real(JPN_REAL_RETURN, TEN_YEAR_JPN, CPI_JPN, start_date)
-
-        compared = pandas.concat([us_rtn, uk_rtn, eur_rtn, jpn_rtn])
-        pivot = compared.pivot(index=DATE, columns=COUNTRY,
-                               values=REAL_RETURN)
+    def compare_real_returns(self, start_date=START_DATE, pairs=None):
+        '''Compare real returns of pairs dictionary of name to (bond, cpi),
+           default REAL_RETURN_PAIRS. Computed in one pass for all pairs,
+           the chart of each pair (as real) and the comparison are rendered
+           in one batch'''
+        pairs = REAL_RETURN_PAIRS if pairs is None else pairs
+        pivot = self._data.real_return_panel(pairs, start_date)
+        pivot.columns.name = COUNTRY
         pivot.reset_index(inplace=True)
-        self._log.info(self._data.chart(COMPARE_REAL_RETURNS, pivot))
+        charts = []
+        for name in pairs:
+            country = pivot[[DATE, name]].dropna().rename(
+                columns={name: REAL_RETURN}).reset_index(drop=True)
+            country.insert(COLUMN_LOCATION, COUNTRY, name)
+            charts.append((name, country))
+        charts.append((COMPARE_REAL_RETURNS, pivot))
+        self._data.charts(charts)
         return pivot
 
+    def provider_pairs(self):
+        '''Real return pairs of every country with a 10Year bond and
+           Inflation in the provider table'''
+        return {COUNTRY_REAL_RETURN.format(country): pair for country, pair
+                in self._data.real_return_pairs().items()}
+
     def country_assets(self):
         '''Country'''
         us_real_return = self.real(US_REAL_RETURN, TEN_YEAR_US, CPI_US,
@@ -87,6 +102,8 @@ class Returns(metaclass=Logged):
         us_share_return = self._data.resample([INDEX_US], START_DATE)
         real_rate = us_real_return[[DATE, REAL_RETURN]]
         share = us_share_return[[DATE, TOTAL_RETURN]]
-        result = self._data.concatenate(real_rate, share)
-        self._log.info(self._data.chart("Country Assets", result))
+        result = align([real_rate, share], tolerance=REAL_RETURN_TOLERANCE)
+        result.index = result.index.strftime(SHORT_DATE)
+        result.reset_index(inplace=True)
+        self._data.chart("Country Assets", result)
         return result
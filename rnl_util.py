@@ -4,23 +4,110 @@
                 try/except block to wrap the called function or method
                 a) log_call to decorate function or method with logging
                 b) profiler to add timing information for optimisation
+                c) unlogged to leave a hot method unwrapped
+                d) histogram to record latency buckets of a method
+                Call logging does no work unless DEBUG is enabled, arguments
+                are rendered only when written and capped in size (large
+                dataframes are summarised by shape). RNL_LOG_CALLS=0 turns
+                wrapping off altogether
     2) Logged usage - decorator for logging = @Logged.log_call. To profile code
-                use @Logged.profiler
-    3) Dependencies - standard libraries
+                use @Logged.profiler. To exclude use @Logged.unlogged
+    3) configure - root logging to file, called by Logged.logger on first use
+                so importing this module has no side effects. Loggers and
+                their handlers are kept in a process wide registry so each
+                named logger is set up once and each file is opened once
+    4) LRUCache - size bounded least recently used cache with entries tagged
+                by symbol so writes can invalidate them, with hit/miss stats
+    5) Metrics - process wide registry of call counts, latency histograms
+                and counters (rows read/written, bytes fetched per host).
+                Logged counts every wrapped call in METRICS and times one
+                call in LATENCY_SAMPLE (mean and estimated total), methods
+                marked with histogram are timed on every call with max and
+                buckets. Export as JSON with METRICS.export(filename)
+    6) Dependencies - standard libraries
                 a) logging (DEBUG, INFO, WARN (default = 30), ERROR, CRITICAL)
                 b) functools (wrap function or method with help documentation)
-                c) cProfile to profile code performance, use pstats to read '''
+                c) cProfile to profile code performance, use pstats to read
+                d) collections and threading for the cache
+                e) reprlib to cap the size of logged arguments
+                f) time, bisect and json for metrics '''
+import os
+import time
+import json
+import bisect
 import logging
 import functools
 import cProfile
+import reprlib
+import threading
+from collections import OrderedDict
 
-LOG_LOCATION = "c:\\temp\\"
+# Log location can be set with RNL_LOG_LOCATION (including trailing separator)
+LOG_LOCATION = os.environ.get("RNL_LOG_LOCATION", "c:\\temp\\")
 LOG_FILE = "logged.txt"
 LOG_LEVEL = logging.INFO
 LOG_FORMAT = "%(asctime)s: %(name)s: %(message)s"
+CACHE_SIZE = 128
+# Method calls are logged to a named logger as the module level functions
+# (logging.debug...) would configure the root logger to the console
+CALL_LOG = logging.getLogger(__name__)
+# Set RNL_LOG_CALLS=0 to create classes without call logging wrappers
+LOG_CALLS = os.environ.get("RNL_LOG_CALLS", "1") != "0"
+UNLOGGED = "_unlogged"
+HISTOGRAM = "_histogram"
+# Logged arguments are capped to this many characters per string/container
+ARGUMENT_SIZE = 80
+ARGUMENT_ITEMS = 6
+# Upper bounds (seconds) of latency histogram buckets, last is unbounded
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+OVERFLOW_BUCKET = "+inf"
+# Wrapped calls not marked histogram are timed one call in this many
+LATENCY_SAMPLE = 16
+# Profiles accumulate across calls so each dump holds every call so far
+_PROFILES = {}
+# Registry of loggers by (name, filename, format) and handlers by
+# (filename, format) so creating objects does not add handlers
+_LOGGERS = {}
+_HANDLERS = {}
+_LOGGER_LOCK = threading.Lock()
 
-logging.basicConfig(filename=LOG_LOCATION + LOG_FILE, level=LOG_LEVEL,
-                    format=LOG_FORMAT)
+
+class _Arguments(object):
+    '''Arguments of a logged call rendered only if the message is written.
+       Anything with a shape (dataframe, series, array) is shown by type and
+       shape, everything else by a size capped repr'''
+    _repr = reprlib.Repr()
+    _repr.maxstring = ARGUMENT_SIZE
+    _repr.maxother = ARGUMENT_SIZE
+    _repr.maxlist = _repr.maxtuple = _repr.maxdict = ARGUMENT_ITEMS
+
+    def __init__(self, values):
+        '''Hold arguments (tuple) or keywords (dict) without rendering'''
+        self._values = values
+
+    @classmethod
+    def _render(cls, value):
+        '''Short representation of one argument'''
+        shape = getattr(value, "shape", None)
+        if shape is not None:
+            return "<{} {}>".format(type(value).__name__,
+                                    "x".join(str(size) for size in shape))
+        return cls._repr.repr(value)
+
+    def __str__(self):
+        '''Render arguments when the log record is formatted'''
+        if isinstance(self._values, dict):
+            return "{" + ", ".join("{!r}: {}".format(key, self._render(value))
+                                   for key, value in self._values.items()) \
+                + "}"
+        return "(" + ", ".join(self._render(value)
+                               for value in self._values) + ")"
+
+
+def configure(filename=LOG_LOCATION + LOG_FILE):
+    '''Configure root logging to file. Called when the first logger is
+       created rather than on import so importing has no side effects'''
+    logging.basicConfig(filename=filename, level=LOG_LEVEL, format=LOG_FORMAT)
 
 
 class Logged(type):
@@ -29,28 +116,70 @@ class Logged(type):
     """
     def __new__(mcs, name, bases, attrs):
         for key, value in attrs.items():
-            if callable(value):
+            if not LOG_CALLS or getattr(getattr(value, "__func__", value),
+                                        UNLOGGED, False):
+                continue
+            # staticmethod is callable from Python 3.10 so wrap the function
+            # inside it, otherwise it would be called with self
+            if isinstance(value, (staticmethod, classmethod)):
+                attrs[key] = type(value)(mcs.log_call(value.__func__))
+            elif callable(value):
                 attrs[key] = mcs.log_call(value)
         return super(Logged, mcs).__new__(mcs, name, bases, attrs)
 
+    def unlogged(func):
+        """Mark function so the metaclass does not wrap it, for methods called
+        too often (or from tight loops) to be worth logging."""
+        setattr(func, UNLOGGED, True)
+        return func
+
+    def histogram(func):
+        """Mark function so every call is timed and recorded in latency
+        buckets with the longest call, for methods slow enough for that to
+        matter. Other wrapped calls are counted and only sampled for time."""
+        setattr(func, HISTOGRAM, True)
+        return func
+
     @staticmethod
     def log_call(func):
         """Given a function, wrap it with some logging code and
         return the wrapped function.
         """
+        latency = METRICS.latency(func.__qualname__)
+        histogram = getattr(func, HISTOGRAM, False)
+        perf_counter = time.perf_counter
+
         @functools.wraps(func)
         def inner(*args, **kwargs):
             ''' Inner '''
-            logging.debug('Function %s was called with arguments %r and '
-                          'keywords %r.' % (func.__name__, args, kwargs))
+            if not CALL_LOG.isEnabledFor(logging.DEBUG):
+                # Count every call, time a sample unless histogram
+                latency.calls += 1
+                start = perf_counter() if histogram or \
+                    not latency.calls % LATENCY_SAMPLE else None
+                try:
+                    return func(*args, **kwargs)
+                except Exception as exc:
+                    CALL_LOG.critical('Function call to %s raised exception: '
+                                      '%r', func.__name__, exc)
+                    raise
+                finally:
+                    if start is not None:
+                        latency.sample(perf_counter() - start, histogram)
+            start = perf_counter()
+            CALL_LOG.debug('Function %s was called with arguments %s and '
+                           'keywords %s.', func.__name__, _Arguments(args),
+                           _Arguments(kwargs))
             try:
                 response = func(*args, **kwargs)
-                logging.debug('Function %s was successful.' % func.__name__)
+                CALL_LOG.debug('Function %s was successful.', func.__name__)
                 return response
             except Exception as exc:
-                logging.critical('Function call to %s raised exception: %r' %
-                                 (func.__name__, exc))
+                CALL_LOG.critical('Function call to %s raised exception: %r',
+                                  func.__name__, exc)
                 raise
+            finally:
+                latency.observe(perf_counter() - start, histogram)
         return inner
 
     def profiler(func):
@@ -62,29 +191,216 @@ class Logged(type):
             '''Read dump file with pstats - pstats.Stats(func.__name__.profile")
                                             prf.sort_stats("time")
                                             prf.print_stats()'''
-            logging.debug('The function %s was called with arguments %r and '
-                          'keywords %r.' % (func.__name__, args, kwargs))
+            CALL_LOG.debug('The function %s was called with arguments %s and '
+                           'keywords %s.', func.__name__, _Arguments(args),
+                           _Arguments(kwargs))
             try:
-                profile = cProfile.Profile()
+                profile = _PROFILES.setdefault(func.__qualname__,
+                                               cProfile.Profile())
+                start = time.perf_counter()
                 result = profile.runcall(func, *args, **kwargs)
+                METRICS.observe(func.__qualname__, time.perf_counter() - start)
                 profile.dump_stats(func.__name__ + ".profile")
-                logging.debug('Function %s was successful.' % func.__name__)
+                CALL_LOG.debug('Function %s was successful.', func.__name__)
                 return result
             except Exception as exc:
-                logging.critical('Function call to %s raised exception: %r' %
-                                 (func.__name__, exc))
+                CALL_LOG.critical('Function call to %s raised exception: %r',
+                                  func.__name__, exc)
                 raise
         return inner
 
     def logger(name, filename=LOG_LOCATION + LOG_FILE, format=LOG_FORMAT):
-        '''Return a new logger to the caller and output to both console and
-           file using the same format'''
-        logger = logging.getLogger(name)
-        logger.setLevel(LOG_LEVEL)
-        file_handler = logging.FileHandler(filename)
-        file_handler.setFormatter(logging.Formatter(format))
-        stream_handler = logging.StreamHandler()
-        stream_handler.setFormatter(logging.Formatter(format))
-        logger.addHandler(file_handler)
-        logger.addHandler(stream_handler)
+        '''Return logger output to both console and file using the same
+           format. Handlers are added the first time a name is used and
+           shared by every logger writing to the same file'''
+        key = (name, filename, format)
+        with _LOGGER_LOCK:
+            logger = _LOGGERS.get(key)
+            if logger is None:
+                configure(filename)
+                handlers = _HANDLERS.get((filename, format))
+                if handlers is None:
+                    file_handler = logging.FileHandler(filename)
+                    stream_handler = logging.StreamHandler()
+                    handlers = [file_handler, stream_handler]
+                    for handler in handlers:
+                        handler.setFormatter(logging.Formatter(format))
+                    _HANDLERS[(filename, format)] = handlers
+                logger = logging.getLogger(name)
+                logger.setLevel(LOG_LEVEL)
+                for handler in handlers:
+                    logger.addHandler(handler)
+                # Root also logs to the file, do not write messages twice
+                logger.propagate = False
+                _LOGGERS[key] = logger
         return logger
+
+
+class LRUCache(object):
+    '''Least recently used cache holding at most size entries. Each entry
+       is tagged with the symbols it was built from so invalidate(symbols)
+       removes everything derived from data that has changed. Thread safe'''
+    def __init__(self, size=CACHE_SIZE):
+        '''Initialise empty cache and statistics'''
+        self._size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def __len__(self):
+        '''Number of entries held'''
+        return len(self._entries)
+
+    def get(self, key):
+        '''Return cached value or None, marking entry most recently used'''
+        with self._lock:
+            if key not in self._entries:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return self._entries[key][1]
+
+    def set(self, key, value, symbols=()):
+        '''Add value tagged by symbols, evicting least recently used'''
+        with self._lock:
+            self._entries[key] = (frozenset(symbols), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, symbols=None):
+        '''Remove entries built from any of the symbols or all if None'''
+        with self._lock:
+            if symbols is None:
+                stale = list(self._entries)
+            else:
+                symbols = frozenset(symbols)
+                stale = [key for key, (tags, _) in self._entries.items()
+                         if tags & symbols]
+            for key in stale:
+                del self._entries[key]
+            self._invalidations += len(stale)
+            return len(stale)
+
+    def stats(self):
+        '''Hit, miss, eviction and invalidation counts to tune size'''
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {"size": len(self._entries),
+                    "maxsize": self._size,
+                    "hits": self._hits,
+                    "misses": self._misses,
+                    "hit_rate": self._hits / lookups if lookups else 0.0,
+                    "evictions": self._evictions,
+                    "invalidations": self._invalidations}
+
+
+class _Latency(object):
+    '''Latency histogram of one name. Calls are counted separately from
+       the calls timed, which may be a sample. Updates are not locked to
+       keep them cheap enough for every call, so concurrent threads may
+       rarely lose an update which is acceptable for monitoring'''
+    __slots__ = ("calls", "timed", "total", "longest", "buckets")
+
+    def __init__(self):
+        '''Initialise empty histogram'''
+        self.calls = 0
+        self.timed = 0
+        self.total = 0.0
+        self.longest = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def sample(self, seconds, histogram=True):
+        '''Record time of a call already counted, in the histogram (max
+           and buckets) if histogram'''
+        self.timed += 1
+        self.total += seconds
+        if histogram:
+            if seconds > self.longest:
+                self.longest = seconds
+            self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def observe(self, seconds, histogram=True):
+        '''Record one call taking seconds'''
+        self.calls += 1
+        self.sample(seconds, histogram)
+
+
+class Metrics(object):
+    '''Registry of latency histograms (count, total, max and count per
+       bucket of LATENCY_BUCKETS) and counters by name. Recording is cheap
+       enough to stay on in production runs'''
+    def __init__(self):
+        '''Initialise empty registry'''
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._counters = {}
+        self._started = time.time()
+
+    def latency(self, name):
+        '''Histogram for name, created on first use. Callers recording
+           often (Logged) keep it rather than looking it up each time'''
+        latency = self._latency.get(name)
+        if latency is None:
+            with self._lock:
+                latency = self._latency.setdefault(name, _Latency())
+        return latency
+
+    def observe(self, name, seconds):
+        '''Record one call of name taking seconds'''
+        self.latency(name).observe(seconds)
+
+    def count(self, name, value=1):
+        '''Add value to counter name (rows_read, bytes_fetched.quandl...)'''
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def reset(self):
+        '''Clear all metrics, histograms held by callers are emptied'''
+        with self._lock:
+            for latency in self._latency.values():
+                latency.__init__()
+            self._counters.clear()
+            self._started = time.time()
+
+    def report(self):
+        '''Dictionary of all metrics suitable for JSON'''
+        bounds = [str(bound) for bound in LATENCY_BUCKETS] + [OVERFLOW_BUCKET]
+        with self._lock:
+            latency = {}
+            for name, value in self._latency.items():
+                if not value.calls:
+                    continue
+                latency[name] = {"calls": value.calls,
+                                 "timed_calls": value.timed}
+                if value.timed:
+                    # Total of sampled calls is estimated from their mean
+                    mean = value.total / value.timed
+                    latency[name].update(mean_seconds=mean,
+                                         total_seconds=mean * value.calls)
+                if any(value.buckets):
+                    latency[name].update(
+                        max_seconds=value.longest,
+                        buckets=dict(zip(bounds, value.buckets)))
+            return {"started": self._started,
+                    "exported": time.time(),
+                    "latency": latency,
+                    "counters": dict(self._counters)}
+
+    def to_json(self):
+        '''All metrics as a JSON string'''
+        return json.dumps(self.report(), indent=1, sort_keys=True)
+
+    def export(self, filename):
+        '''Write all metrics to filename as JSON'''
+        with open(filename, "w") as output:
+            output.write(self.to_json())
+        return filename
+
+
+METRICS = Metrics()
@@ -0,0 +1,262 @@
+'''
+Read only HTTP query service so dashboards and notebooks share one warm
+Database instead of each loading prices from cold. Endpoints return JSON
+(default) or CSV with ?format=csv
+
+    /series?symbols=^FTAS,^GSPC&start=2016&end=2017&wide=1
+    /resample?symbols=^FTAS&start=2016&period=M
+    /real-returns?start=2015[&provider=1]
+    /comparators?group=10Year[&aligned=0]
+    /momentum?symbols=^FTAS,GLD[&horizons=3,12]
+    /watermark
+
+Every response has an ETag made from the endpoint, its parameters and the
+watermark (last date, count and write version) of the symbols it reads,
+so a client sending If-None-Match gets 304 Not Modified until prices of
+those symbols are written (new or revised). Responses are cached by ETag.
+The watermark is read at most every refresh seconds and results of symbols
+written by another process (update) are invalidated when it changes.
+Requests are served in threads. The service only reads: resampled and real
+returns come from the materialized returns kept by update when they are
+current and are otherwise resampled in memory (Database.resample), and the
+default Database is read only
+'''
+import json
+import time
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from database import Database, MONTH, HORIZONS, START
+from returns import REAL_RETURN_PAIRS, Returns
+from rnl_util import Logged, LRUCache, CACHE_SIZE
+
+HOST = "127.0.0.1"
+PORT = 8000
+# Seconds between reads of the price watermark
+REFRESH = 5.0
+JSON = "json"
+CSV = "csv"
+CONTENT_TYPE = {JSON: "application/json", CSV: "text/csv"}
+RECORDS = "records"
+ISO = "iso"
+SEPARATOR = ","
+TRUE = ["1", "true", "yes"]
+ETAG = '"{}"'
+ETAG_LENGTH = 16
+UNKNOWN_ENDPOINT = "Unknown endpoint {}"
+MISSING_PARAMETER = "Missing parameter {}"
+UNKNOWN_GROUP = "Unknown comparison group {}"
+
+
+class Service(metaclass=Logged):
+    '''Queries of a shared Database answered as JSON or CSV bytes with an
+       ETag. Public methods:
+           watermark - symbol watermarks, refreshed at most every refresh
+           query - body, content type and ETag of an endpoint'''
+    def __init__(self, database=None, refresh=REFRESH, cache_size=CACHE_SIZE):
+        '''Initialise with a Database (default prices.db read only)'''
+        self._data = Database(read_only=True) if database is None \
+            else database
+        self._refresh = refresh
+        self._responses = LRUCache(cache_size)
+        self._lock = threading.Lock()
+        self._watermark = None
+        self._read = 0.0
+        self._log = Logged.logger(__name__)
+        self._endpoints = {"/series": self._series,
+                           "/resample": self._resample,
+                           "/real-returns": self._real_returns,
+                           "/comparators": self._comparators,
+                           "/momentum": self._momentum,
+                           "/watermark": self._watermarks}
+
+    def watermark(self):
+        '''Dictionary of symbol to (last date, count, write version). When
+           it changes the cached results of the changed symbols are
+           invalidated'''
+        with self._lock:
+            if time.monotonic() - self._read < self._refresh:
+                return self._watermark
+            watermark = self._data.watermarks()
+            if self._watermark is not None:
+                changed = {symbol for symbol in set(watermark) |
+                           set(self._watermark)
+                           if watermark.get(symbol) !=
+                           self._watermark.get(symbol)}
+                if changed:
+                    self._log.info("Prices changed for %i symbols",
+                                   len(changed))
+                    self._data.invalidate(changed)
+                    self._responses.invalidate(changed)
+            self._watermark = watermark
+            self._read = time.monotonic()
+            return watermark
+
+    @staticmethod
+    @Logged.unlogged
+    def _list(params, name, default=None):
+        '''Comma separated parameter as a list'''
+        if name not in params:
+            if default is None:
+                raise ValueError(MISSING_PARAMETER.format(name))
+            return default
+        return params[name].split(SEPARATOR)
+
+    def _series(self, params):
+        '''Prices of symbols between dates, long or wide'''
+        symbols = self._list(params, "symbols")
+        wide = params.get("wide", "").lower() in TRUE
+        return symbols, lambda: self._data.get_data(
+            symbols, params.get("start"), params.get("end"), wide=wide)
+
+    def _resample(self, params):
+        '''Resampled prices with percent change and total return'''
+        symbols = self._list(params, "symbols")
+        return symbols, lambda: self._data.resample(
+            symbols, params.get("start"), params.get("period", MONTH))
+
+    def _real_returns(self, params):
+        '''Real return of each country, configured or from provider'''
+        if params.get("provider", "").lower() in TRUE:
+            pairs = Returns(self._data).provider_pairs()
+        else:
+            pairs = REAL_RETURN_PAIRS
+        symbols = [symbol for pair in pairs.values() for symbol in pair]
+        return symbols, lambda: self._data.real_return_panel(
+            pairs, params.get("start"))
+
+    def _comparators(self, params):
+        '''Aligned prices of one comparison group (reads every symbol)'''
+        group = params.get("group")
+        if group is None:
+            raise ValueError(MISSING_PARAMETER.format("group"))
+        aligned = params.get("aligned", "1").lower() in TRUE
+
+        def compute():
+            '''Panel of the group'''
+            panels = self._data.comparator_panels(aligned)
+            if group not in panels:
+                raise KeyError(UNKNOWN_GROUP.format(group))
+            return panels[group]
+        return None, compute
+
+    def _momentum(self, params):
+        '''Percent change over each horizon'''
+        symbols = self._list(params, "symbols")
+        horizons = [int(horizon) for horizon in
+                    self._list(params, "horizons", HORIZONS)]
+        return symbols, lambda: self._data.momentum(
+            symbols, horizons, params.get("period", MONTH))
+
+    def _watermarks(self, params):
+        '''Last date and count of every symbol'''
+        return None, self._data.watermark
+
+    def _etag(self, path, params, symbols):
+        '''Tag of endpoint, parameters and watermark of symbols read'''
+        watermark = self.watermark()
+        if symbols is None:
+            held = sorted(watermark.items())
+        else:
+            held = [(symbol, watermark.get(symbol))
+                    for symbol in sorted(set(symbols))]
+        digest = hashlib.sha1(json.dumps([path, sorted(params.items()),
+                                          held]).encode())
+        return ETAG.format(digest.hexdigest()[:ETAG_LENGTH])
+
+    @staticmethod
+    @Logged.unlogged
+    def _body(result, output):
+        '''Dataframe as JSON records or CSV bytes, index kept as columns'''
+        if result.index.name is not None or result.index.nlevels > 1:
+            result = result.reset_index()
+        if output == CSV:
+            return result.to_csv(index=False).encode()
+        return result.to_json(orient=RECORDS, date_format=ISO).encode()
+
+    @Logged.histogram
+    def query(self, path, params, etag=None):
+        '''Answer endpoint with parameters (dictionary of strings). Returns
+           body (None if etag is current), content type and ETag. Raises
+           KeyError for unknown endpoints and ValueError for bad parameters'''
+        if path not in self._endpoints:
+            raise KeyError(UNKNOWN_ENDPOINT.format(path))
+        output = params.pop("format", JSON)
+        if output not in CONTENT_TYPE:
+            raise ValueError(output)
+        symbols, compute = self._endpoints[path](params)
+        current = self._etag(path, params, symbols)
+        if etag == current:
+            return None, CONTENT_TYPE[output], current
+        key = (current, output)
+        body = self._responses.get(key)
+        if body is None:
+            body = self._body(compute(), output)
+            tags = self._watermark if symbols is None else symbols
+            self._responses.set(key, body, tags)
+        return body, CONTENT_TYPE[output], current
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''GET requests answered by the server's Service'''
+    def do_GET(self):
+        '''Answer query, 304 if If-None-Match is current'''
+        url = urlsplit(self.path)
+        params = {name: values[-1] for name, values
+                  in parse_qs(url.query).items()}
+        try:
+            body, content_type, etag = self.server.service.query(
+                url.path, params, self.headers.get("If-None-Match"))
+        except KeyError as exc:
+            return self._error(404, exc)
+        except ValueError as exc:
+            return self._error(400, exc)
+        except Exception as exc:
+            Logged.logger(__name__).info("Query %s failed: %r", self.path,
+                                         exc)
+            return self._error(500, exc)
+        if body is None:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, exc):
+        '''Plain text error'''
+        body = str(exc.args[START] if exc.args else exc).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        '''Request log to the service logger rather than stderr'''
+        Logged.logger(__name__).debug(format, *args)
+
+
+def server(service, host=HOST, port=PORT):
+    '''Threading HTTP server for service, call serve_forever to run'''
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    httpd.service = service
+    return httpd
+
+
+def serve(database=None, host=HOST, port=PORT, refresh=REFRESH):
+    '''Run service on host and port until interrupted'''
+    httpd = server(Service(database, refresh), host, port)
+    Logged.logger(__name__).info("Serving on http://%s:%i", host, port)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
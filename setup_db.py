@@ -2,23 +2,43 @@
 Setup database using SQLite3 which is deprecated by pandas, which is
 using SQLAlchemy. Since database creation is one-off seems unimportant
 '''
+import sys
 import sqlite3
-from prices import Host, Database
+from database import Database
 
 
 DATABASE_NAME = "test_db.db"
 SQLALCHEMY_DB = "sqlite:///"
-CREATE_PRICE = '''CREATE TABLE price (symbol text, date text, price real)'''
+# Price is keyed and clustered on (symbol, date) so lookups are index seeks
+# and appends are upserts. Without rowid the key is the only copy of symbol
+# and date (no separate index). Dates stay as 10 character ISO text as
+# string comparisons on date (i.e. > "2016") are used throughout
+CREATE_PRICE = '''CREATE TABLE price
+                    (symbol text NOT NULL, date text NOT NULL, price real,
+                    PRIMARY KEY (symbol, date)) WITHOUT ROWID'''
+# Index for databases created before the key, replaced by migrate_db
+CREATE_PRICE_INDEX = '''CREATE INDEX IF NOT EXISTS price_symbol_date
+                        ON price (symbol, date)'''
+# Country pairs 10Year bonds with Inflation for real returns
 CREATE_PROVIDER = '''CREATE TABLE provider
                         (symbol text, description text, source text,
-                        host text, comparison text)'''
-PROVIDER_TABLE = "provider"
+                        host text, comparison text, country text)'''
+# Migrate unkeyed price table, duplicates keep the most recently added price
+MIGRATE_PRICE = ["ALTER TABLE price RENAME TO price_unkeyed",
+                 CREATE_PRICE,
+                 '''INSERT OR REPLACE INTO price (symbol, date, price)
+                    SELECT symbol, substr(date, 1, 10), price
+                    FROM price_unkeyed
+                    WHERE symbol IS NOT NULL AND date IS NOT NULL
+                    ORDER BY rowid''',
+                 "DROP TABLE price_unkeyed"]
+COUNT_PRICE = "SELECT count(*) FROM price"
 PROVIDER_CSV = "provider.csv"
 
 
-def execute(sql_query):
+def execute(sql_query, database=DATABASE_NAME):
     '''Connect to a database to execute SQL'''
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = sqlite3.connect(database)
     cur = conn.cursor()
     result = cur.execute(sql_query)
     conn.commit()
@@ -35,16 +55,49 @@ def create_db():
     print('Successfully created database tables in: ' + DATABASE_NAME)
 
 
+def create_index(database=DATABASE_NAME):
+    '''Add price index to an existing database (e.g. prices.db)'''
+    print('Creating price index in: ' + database)
+    execute(CREATE_PRICE_INDEX, database)
+    print('Successfully created price index in: ' + database)
+
+
+def migrate_db(database=DATABASE_NAME):
+    '''Rebuild price table of an existing database (e.g. prices.db) with
+       the (symbol, date) key, removing duplicates in one transaction'''
+    print('Migrating price table to keyed table in: ' + database)
+    conn = sqlite3.connect(database, isolation_level=None)
+    before = conn.execute(COUNT_PRICE).fetchone()[0]
+    conn.execute("BEGIN")
+    try:
+        for sql_query in MIGRATE_PRICE:
+            conn.execute(sql_query)
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        conn.close()
+        raise
+    after = conn.execute(COUNT_PRICE).fetchone()[0]
+    # Reclaim space from the old table and refresh query planner statistics
+    conn.execute("VACUUM")
+    conn.execute("ANALYZE")
+    conn.close()
+    print('Successfully migrated {} prices ({} duplicates removed)'
+          .format(after, before - after))
+
+
 def add_provider(filename=PROVIDER_CSV):
     '''populate provider table with content of CSV file'''
     print("Updating Provider with CSV data from {}".format(filename))
     data = Database(SQLALCHEMY_DB + DATABASE_NAME)
-    host = Host()
-    result = host.get_csv(filename)
-    data.set(PROVIDER_TABLE, result)
+    data.replace_provider(filename)
     print("Successfully updated Provider with content of {}".format(filename))
 
 
 if __name__ == '__main__':
-    create_db()
-    add_provider()
+    # python setup_db.py migrate prices.db - migrate an existing database
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        migrate_db(*sys.argv[2:])
+    else:
+        create_db()
+        add_provider()
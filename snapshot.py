@@ -0,0 +1,226 @@
+'''
+Columnar snapshot of the price table for fast analytic startup. Each symbol
+is held as two NumPy arrays saved as .npy files, dates as datetime64[D] and
+prices as float64, so they are loaded with memory mapping and sliced by date
+without parsing text dates through SQL. A JSON manifest records the last date,
+count and write version of each symbol (the database watermark) at the time
+it was written so refresh only reads rows from the earliest date written
+since then, which may be before the last date when a price was revised
+'''
+import os
+import json
+from urllib.parse import quote
+import numpy
+import pandas
+from database import DATE, SYMBOL, PRICE, LAST_DATE, COUNT, VERSION, \
+    START, SLICE_DATE, DATE_DAY, DAY
+from rnl_util import Logged
+
+SNAPSHOT_LOCATION = "snapshot"
+MANIFEST_FILE = "manifest.json"
+DATES_FILE = "{}.dates.npy"
+PRICES_FILE = "{}.prices.npy"
+TEMP_FILE = "{}.tmp"
+FILE = "file"
+MMAP_READ = "r"
+LEFT = "left"
+RIGHT = "right"
+
+
+class Snapshot(metaclass=Logged):
+    '''Memory mapped per-symbol arrays of the price table. Symbols written to
+       the database since the last refresh are marked stale and are not
+       loaded from the snapshot until refresh has brought them up to date.
+       Public methods:
+           refresh - rewrite symbols from the earliest date written
+           invalidate - mark symbols stale after a database write
+           verify - mark symbols stale whose manifest is behind the database
+           covers - check if all symbols can be loaded from the snapshot
+           load - long or wide dataframe of symbols between dates'''
+    def __init__(self, location=SNAPSHOT_LOCATION):
+        '''Initialise snapshot directory and read manifest'''
+        self._location = location
+        self._log = Logged.logger(__name__)
+        os.makedirs(location, exist_ok=True)
+        # Stale symbols and the earliest date written, None if not known
+        self._stale = {}
+        try:
+            with open(self._path(MANIFEST_FILE)) as manifest:
+                self._manifest = json.load(manifest)
+        except FileNotFoundError:
+            self._manifest = {}
+
+    def _path(self, filename):
+        '''Full path of file in snapshot location'''
+        return os.path.join(self._location, filename)
+
+    def _write(self, filename, array):
+        '''Write array to temporary file then replace so readers holding a
+           memory map of the previous version are not affected'''
+        temp = self._path(TEMP_FILE.format(filename))
+        with open(temp, "wb") as output:
+            numpy.save(output, array)
+        os.replace(temp, self._path(filename))
+
+    def _write_manifest(self):
+        '''Write manifest after symbol arrays so it never points ahead'''
+        temp = self._path(TEMP_FILE.format(MANIFEST_FILE))
+        with open(temp, "w") as manifest:
+            json.dump(self._manifest, manifest, indent=1, sort_keys=True)
+        os.replace(temp, self._path(MANIFEST_FILE))
+
+    def _read(self, symbol):
+        '''Memory mapped dates and prices of symbol'''
+        name = self._manifest[symbol][FILE]
+        dates = numpy.load(self._path(DATES_FILE.format(name)),
+                           mmap_mode=MMAP_READ)
+        prices = numpy.load(self._path(PRICES_FILE.format(name)),
+                            mmap_mode=MMAP_READ)
+        return dates, prices
+
+    def _store(self, symbol, data, keep, manifest):
+        '''Write arrays of symbol from database data after the first keep
+           rows held'''
+        dates = pandas.to_datetime(data[DATE]).values.astype(DATE_DAY)
+        prices = data[PRICE].values.astype(numpy.float64)
+        if keep:
+            old_dates, old_prices = self._read(symbol)
+            dates = numpy.concatenate([old_dates[:keep], dates])
+            prices = numpy.concatenate([old_prices[:keep], prices])
+        self._write(DATES_FILE.format(manifest[FILE]), dates)
+        self._write(PRICES_FILE.format(manifest[FILE]), prices)
+        self._manifest[symbol] = manifest
+
+    def _kept(self, database, symbol, version):
+        '''Number of held rows of symbol dated before anything written
+           since the snapshot, 0 if it has to be rewritten'''
+        held = self._manifest.get(symbol)
+        if held is None or held.get(VERSION) is None:
+            return 0
+        written = [self._stale[symbol]] \
+            if self._stale.get(symbol) is not None else []
+        if held[VERSION] != version:
+            # Written by any process, from the database write log
+            written.append(database._written_since(symbol, held[VERSION]))
+            if written[-1] is None:
+                return 0
+        dates, _ = self._read(symbol)
+        if not written:
+            return len(dates)
+        return int(numpy.searchsorted(dates, numpy.datetime64(
+            min(written)[START:SLICE_DATE], DAY), side=LEFT))
+
+    def refresh(self, database, watermark=None):
+        '''Bring snapshot up to date with database (or its watermark if
+           already read). Symbols written since the snapshot are read again
+           from the earliest date written (revised prices as well as new
+           ones) and rewritten if that would not give the database count.
+           Symbols are only marked current once read again'''
+        if watermark is None:
+            watermark = database.watermark()
+        updated = 0
+        for symbol, value in watermark.iterrows():
+            manifest = {FILE: quote(symbol, safe=""),
+                        LAST_DATE: value[LAST_DATE][START:SLICE_DATE],
+                        COUNT: int(value[COUNT]),
+                        VERSION: int(value[VERSION])}
+            if symbol not in self._stale and \
+                    self._manifest.get(symbol) == manifest:
+                continue
+            keep = self._kept(database, symbol, manifest[VERSION])
+            # Rows are read with SQL as get_data may be served from here
+            if keep:
+                dates, _ = self._read(symbol)
+                data = database._select_prices([symbol],
+                                               str(dates[keep - 1]))
+                if keep + len(data) != manifest[COUNT]:
+                    keep = 0
+            if not keep:
+                data = database._select_prices([symbol])
+            self._store(symbol, data, keep, manifest)
+            self._stale.pop(symbol, None)
+            updated += 1
+        if updated:
+            self._write_manifest()
+        self._log.info("Snapshot refreshed %i of %i symbols", updated,
+                       len(watermark))
+        return updated
+
+    def invalidate(self, symbols):
+        '''Mark symbols as stale until the next refresh. Symbols is a
+           dictionary of symbol to earliest date written, or any iterable
+           of symbols when the dates are not known'''
+        if not isinstance(symbols, dict):
+            symbols = dict.fromkeys(symbols)
+        for symbol, first_date in symbols.items():
+            held = self._stale.get(symbol)
+            if held is not None:
+                first_date = held if first_date is None else \
+                    min(held, first_date)
+            self._stale[symbol] = first_date
+
+    def verify(self, watermark):
+        '''Mark symbols stale whose manifest differs from the database
+           watermark (written by another process since the last refresh).
+           Returns the stale symbols'''
+        held = {symbol: (value[LAST_DATE][START:SLICE_DATE],
+                         int(value[COUNT]), int(value[VERSION]))
+                for symbol, value in watermark.iterrows()}
+        for symbol, manifest in self._manifest.items():
+            if held.get(symbol) != (manifest[LAST_DATE], manifest[COUNT],
+                                    manifest.get(VERSION)):
+                self._stale.setdefault(symbol, None)
+        return set(self._stale)
+
+    def covers(self, symbols):
+        '''True if every symbol is held and up to date'''
+        return all(symbol in self._manifest and symbol not in self._stale
+                   for symbol in symbols)
+
+    @staticmethod
+    @Logged.unlogged
+    def _slice(dates, start_date, end_date):
+        '''Index range of sorted dates matching get_data date filter. A full
+           start date is exclusive, a partial one (2016 or 2016-05) starts
+           from the first day of that period. End includes the period'''
+        first, last = 0, len(dates)
+        if start_date is not None:
+            start = str(start_date)
+            side = RIGHT if len(start) >= SLICE_DATE else LEFT
+            first = numpy.searchsorted(dates, numpy.datetime64(
+                pandas.Timestamp(start).date(), DAY), side=side)
+        if end_date is not None:
+            end = pandas.Period(str(end_date)).end_time.date()
+            last = numpy.searchsorted(dates, numpy.datetime64(end, DAY),
+                                      side=RIGHT)
+        return first, last
+
+    def load(self, symbols, start_date=None, end_date=None, wide=False):
+        '''Load symbols between dates from memory mapped arrays. Returns
+           wide dataframe (datetime index x symbol) or long dataframe
+           (symbol, date, price) with datetime dates ordered by symbol as
+           get_data from SQL'''
+        if not wide:
+            symbols = sorted(symbols)
+        dates, prices = [], []
+        for symbol in symbols:
+            symbol_dates, symbol_prices = self._read(symbol)
+            first, last = self._slice(symbol_dates, start_date, end_date)
+            dates.append(symbol_dates[first:last])
+            prices.append(symbol_prices[first:last])
+
+        if wide:
+            result = pandas.concat(
+                [pandas.Series(price, index=pandas.DatetimeIndex(date))
+                 for date, price in zip(dates, prices)],
+                axis=1, keys=list(symbols))
+            result.index.name = DATE
+            result.columns.name = SYMBOL
+            return result
+
+        lengths = [len(date) for date in dates]
+        return pandas.DataFrame({
+            SYMBOL: numpy.repeat(list(symbols), lengths),
+            DATE: numpy.concatenate(dates) if dates else [],
+            PRICE: numpy.concatenate(prices) if prices else []},
+                                columns=[SYMBOL, DATE, PRICE])
@@ -0,0 +1,114 @@
+'''
+Tests run with pytest from the repository directory (update_concurrent is
+tested in test_update.py):
+    1) startup - import time budget of read commands (main.py startup) in a
+                 new interpreter, without provider clients or matplotlib
+    2) snapshot - prices revised in place are read again by refresh
+    3) materialized returns - same as resample_panel after extension and
+                 after prices are revised'''
+import os
+import sys
+import sqlite3
+import tempfile
+import subprocess
+import pandas
+import pytest
+
+# Logs go to a temporary directory unless set (rnl_util reads it on import)
+os.environ.setdefault("RNL_LOG_LOCATION", tempfile.gettempdir() + os.sep)
+from database import Database, DATE, SYMBOL, PRICE, MONTH
+from setup_db import CREATE_PRICE
+from snapshot import Snapshot
+
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture
+def database(tmp_path):
+    '''New keyed database'''
+    filename = str(tmp_path / "prices.db")
+    connection = sqlite3.connect(filename)
+    connection.execute(CREATE_PRICE)
+    connection.commit()
+    connection.close()
+    return Database("sqlite:///" + filename)
+
+
+def test_startup_budget(tmp_path):
+    '''main.py startup exits 0: imports within budget, no provider modules'''
+    environment = dict(os.environ, RNL_LOG_LOCATION=str(tmp_path) + os.sep)
+    result = subprocess.run([sys.executable, "main.py", "startup"],
+                            cwd=REPOSITORY, env=environment,
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 0, result.stdout
+
+
+def _prices(symbol, dates, prices):
+    '''Price dataframe of one symbol'''
+    return pandas.DataFrame({SYMBOL: symbol, DATE: dates, PRICE: prices})
+
+
+def test_snapshot_revised_price(database, tmp_path):
+    '''A revised price on the last held date is read by refresh'''
+    data = Database(database._database,
+                    snapshot=Snapshot(str(tmp_path / "snapshot")))
+    data._set("price", _prices("Q/GOOD", ["2017-01-02", "2017-01-03",
+                                          "2017-01-04"], [60.0, 61.0, 62.0]))
+    data._refresh_derived()
+    assert data._snapshot.covers(["Q/GOOD"])
+    data._set("price", _prices("Q/GOOD", ["2017-01-04", "2017-01-05"],
+                               [1.0, 2.0]))
+    assert not data._snapshot.covers(["Q/GOOD"])
+    data._refresh_derived()
+    assert data._snapshot.covers(["Q/GOOD"])
+    assert data.get_data(["Q/GOOD"])[PRICE].tolist() == \
+        data._select_prices(["Q/GOOD"])[PRICE].tolist() == \
+        [60.0, 61.0, 1.0, 2.0]
+
+    # Revised by another process: found from the write log on verify
+    Database(database._database)._set("price", _prices(
+        "Q/GOOD", ["2017-01-03"], [5.0]))
+    data = Database(database._database,
+                    snapshot=Snapshot(str(tmp_path / "snapshot")))
+    assert not data._snapshot.covers(["Q/GOOD"])
+    data._refresh_derived()
+    assert data.get_data(["Q/GOOD"])[PRICE].tolist() == [60.0, 5.0, 1.0, 2.0]
+
+
+def _assert_materialized(data, symbols):
+    '''Materialized returns are current and equal to resample_panel'''
+    assert data._returns_current(symbols, MONTH)
+    for start_date in [None, "2015-06-15"]:
+        pandas.testing.assert_frame_equal(
+            data.resample(symbols, start_date),
+            data.resample_panel(symbols, start_date, [MONTH])[MONTH],
+            check_dtype=False)
+
+
+def test_materialized_returns(database):
+    '''Extension with new prices and correction of older prices'''
+    dates = pandas.bdate_range("2014-01-01", "2016-06-30")
+    database._set("price", pandas.concat([
+        _prices(symbol, dates.strftime("%Y-%m-%d"),
+                [float(day % 97 + offset) for day in range(len(dates))])
+        for symbol, offset in [("Q/GOOD", 50), ("Y/GOOD", 80)]]))
+    database._refresh_derived()
+    _assert_materialized(database, ["Q/GOOD", "Y/GOOD"])
+
+    # New months only
+    dates = pandas.bdate_range("2016-07-01", "2016-09-30")
+    database._set("price", _prices("Q/GOOD", dates.strftime("%Y-%m-%d"),
+                                   [70.0] * len(dates)))
+    database._refresh_derived()
+    _assert_materialized(database, ["Q/GOOD", "Y/GOOD"])
+
+    # Month end price revised in place and a restated print months back
+    # arriving with new rows
+    database._set("price", _prices("Y/GOOD", ["2015-03-31"], [1.0]))
+    database._set("price", _prices("Q/GOOD", ["2016-02-29", "2016-10-03"],
+                                   [2.0, 71.0]))
+    assert not database._returns_current(["Y/GOOD"], MONTH)
+    database._refresh_derived()
+    _assert_materialized(database, ["Q/GOOD", "Y/GOOD"])
+    returns = database.resample(["Y/GOOD"]).set_index(DATE)
+    assert returns.loc["2015-03-31", PRICE] == 1.0
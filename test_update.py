@@ -0,0 +1,102 @@
+'''
+Tests of update_concurrent, run with pytest from the repository directory,
+against a fake Host with retries, failures, empty responses and batched
+writes on a new keyed database'''
+import os
+import sqlite3
+import tempfile
+import pandas
+import pytest
+
+# Logs go to a temporary directory unless set (rnl_util reads it on import)
+os.environ.setdefault("RNL_LOG_LOCATION", tempfile.gettempdir() + os.sep)
+from database import Database, DATE, SYMBOL, PRICE, STATUS, ATTEMPTS, \
+    ROWS, UPDATED, FAILED, EMPTY, QUANDL_DATA_PROVIDER, YAHOO_DATA_PROVIDER
+from setup_db import CREATE_PRICE, CREATE_PROVIDER
+
+DAYS = 30
+PROVIDER = [("Q/GOOD", QUANDL_DATA_PROVIDER),
+            ("Q/FLAKY", QUANDL_DATA_PROVIDER),
+            ("Q/DOWN", QUANDL_DATA_PROVIDER),
+            ("Y/GOOD", YAHOO_DATA_PROVIDER),
+            ("Y/NONE", YAHOO_DATA_PROVIDER)]
+
+
+class FakeHost(object):
+    '''Host returning DAYS business days of prices. FLAKY symbols fail on
+       the first request, DOWN symbols always fail and NONE are empty'''
+    def __init__(self):
+        '''Initialise request counts'''
+        self.requests = {}
+
+    def _prices(self, symbol, column):
+        '''Provider shaped dataframe (Date index, price column)'''
+        self.requests[symbol] = self.requests.get(symbol, 0) + 1
+        if "DOWN" in symbol or ("FLAKY" in symbol and
+                                self.requests[symbol] == 1):
+            raise ConnectionError(symbol)
+        dates = pandas.bdate_range("2017-01-02", periods=DAYS, name="Date")
+        if "NONE" in symbol:
+            dates = dates[:0]
+        return pandas.DataFrame({column: range(len(dates))}, index=dates,
+                                dtype=float)
+
+    def get_quandl(self, symbol, start_date=None):
+        '''Quandl style data'''
+        return self._prices(symbol, "Value")
+
+    def get_yahoo(self, symbol, start_date=None):
+        '''Yahoo style data'''
+        return self._prices(symbol, "Close")
+
+
+@pytest.fixture
+def database(tmp_path):
+    '''New keyed database with the PROVIDER symbols and a fake host'''
+    filename = str(tmp_path / "prices.db")
+    connection = sqlite3.connect(filename)
+    connection.execute(CREATE_PRICE)
+    connection.execute(CREATE_PROVIDER)
+    connection.executemany("insert into provider (symbol, host) "
+                           "values (?, ?)", PROVIDER)
+    connection.commit()
+    connection.close()
+    return Database("sqlite:///" + filename, host=FakeHost())
+
+
+def test_update_concurrent(database):
+    '''Retries, failures, empty responses and batched writes'''
+    writes = []
+    write = database._set
+
+    def counted(table, data, *args, **kwargs):
+        '''Record rows of each write'''
+        writes.append(len(data))
+        return write(table, data, *args, **kwargs)
+    database._set = counted
+
+    summary = database.update_concurrent(retries=2, backoff=0, batch_size=2)
+    summary = summary.set_index(SYMBOL)
+    assert summary.loc["Q/GOOD", STATUS] == UPDATED
+    assert summary.loc["Q/FLAKY", [STATUS, ATTEMPTS]].tolist() == [UPDATED, 2]
+    assert summary.loc["Q/DOWN", [STATUS, ATTEMPTS]].tolist() == [FAILED, 2]
+    assert summary.loc["Y/NONE", STATUS] == EMPTY
+    assert summary.loc["Y/GOOD", ROWS] == DAYS
+    # Three updated symbols written two at a time
+    assert writes == [2 * DAYS, DAYS]
+
+    prices = database.get_data(["Q/GOOD", "Q/FLAKY", "Y/GOOD", "Q/DOWN"])
+    assert prices.groupby(SYMBOL).size().to_dict() == {
+        "Q/GOOD": DAYS, "Q/FLAKY": DAYS, "Y/GOOD": DAYS}
+    assert prices[DATE].iloc[0] == "2017-01-02"
+    assert prices[PRICE].iloc[-1] == DAYS - 1
+
+
+def test_update_concurrent_current(database):
+    '''Symbols with prices up to today are not requested again'''
+    database._set("price", pandas.DataFrame({
+        SYMBOL: ["Q/GOOD"], DATE: [str(pandas.Timestamp.today().date())],
+        PRICE: [1.0]}))
+    summary = database.update_concurrent(retries=1, backoff=0)
+    assert "Q/GOOD" not in database._host.requests
+    assert len(summary) == len(PROVIDER)